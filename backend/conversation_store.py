@@ -0,0 +1,790 @@
+# backend/conversation_store.py
+#
+# Conversation history and metadata behind one async interface, so handlers
+# do not care whether it lives in this process or in Redis. Redis is needed
+# once the API runs with more than one worker: each worker would otherwise
+# see only the conversations it created itself.
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Literal, Optional
+import asyncio
+import base64
+import functools
+import itertools
+import os
+import threading
+import weakref
+
+import orjson
+
+Role = Literal["user", "assistant"]
+
+
+class _Conversation:
+    # Everything the in-memory store keeps for one conversation, so a write
+    # finds it all with a single lookup
+    __slots__ = ("meta", "messages_json", "history")
+
+    def __init__(self, meta: dict, history_window: int) -> None:
+        self.meta = meta
+        self.messages_json: list[bytes] = []
+        self.history: deque[tuple[str, int]] = deque(maxlen=history_window)
+
+
+# Per user: conversation id -> record, most recently updated first
+_UserConversations = OrderedDict[str, _Conversation]
+# Stand-in for users with no conversations; never written to
+_NO_CONVERSATIONS: _UserConversations = OrderedDict()
+
+# Timezone-aware UTC now (datetime.utcnow is naive and deprecated), bound
+# once to skip the attribute lookups on every request
+_utcnow = functools.partial(datetime.now, timezone.utc)
+
+
+# Random bytes for ids and tokens, read from the OS 4 KiB at a time instead
+# of one getrandom() call per id or token
+_rand_buf = b""
+_rand_off = 0
+_rand_lock = threading.Lock()
+
+
+def _random_bytes(n: int) -> bytes:
+    global _rand_buf, _rand_off
+    with _rand_lock:
+        if _rand_off + n > len(_rand_buf):
+            _rand_buf = os.urandom(4096)
+            _rand_off = 0
+        chunk = _rand_buf[_rand_off:_rand_off + n]
+        _rand_off += n
+    return chunk
+
+
+def fast_uuid4() -> str:
+    """Same as ``str(uuid.uuid4())``, without a syscall or UUID object per id."""
+    b = bytearray(_random_bytes(16))
+    b[6] = (b[6] & 0x0F) | 0x40  # version 4
+    b[8] = (b[8] & 0x3F) | 0x80  # RFC 4122 variant
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def fast_token_urlsafe(nbytes: int = 32) -> str:
+    """Same format as ``secrets.token_urlsafe(nbytes)``, from the shared buffer."""
+    return base64.urlsafe_b64encode(_random_bytes(nbytes)).rstrip(b"=").decode()
+
+
+def _reset_rand_buf() -> None:
+    global _rand_buf, _rand_off
+    _rand_buf, _rand_off = b"", 0
+
+
+# A forked worker must not hand out the same buffered bytes as its parent
+os.register_at_fork(after_in_child=_reset_rand_buf)
+
+
+def _derive_title(text: str) -> str:
+    cleaned = text.strip()
+    if len(cleaned) > 60:
+        return cleaned[:60] + "..."
+    return cleaned or "New Conversation"
+
+
+def _history_line(role: Role, content: str) -> str:
+    return f"{'User' if role == 'user' else 'Assistant'}: {content}"
+
+
+class ConversationStore(ABC):
+    """Per-user conversations, their messages and per-message token counts.
+
+    Messages are plain dicts shaped like ``ChatMessage``. Conversation
+    metadata dicts carry ``id``, ``title``, ``created_at``, ``updated_at``
+    (ISO strings) and ``message_count``. The last ``history_window`` messages
+    are also kept formatted as prompt lines, so building a prompt never
+    re-formats the history.
+    """
+
+    def __init__(self, history_window: int = 10) -> None:
+        self.history_window = history_window
+
+    @abstractmethod
+    async def ensure_conversation(
+        self, user_id: str, conversation_id: Optional[str], first_message: str
+    ) -> str:
+        """Return ``conversation_id`` if it exists, else create a new one."""
+
+    @abstractmethod
+    async def append_message(
+        self, user_id: str, conversation_id: str, role: Role, content: str, n_tokens: int
+    ) -> Optional[tuple[dict, int]]:
+        """Store a message; returns ``(message, message_count)`` or None if missing."""
+
+    @abstractmethod
+    async def start_turn(
+        self, user_id: str, conversation_id: Optional[str], content: str, n_tokens: int
+    ) -> Optional[tuple[str, int, Optional[dict]]]:
+        """``ensure_conversation`` plus appending the user's message, in one call.
+
+        Returns ``(conversation_id, message_count, previous)``, or None if the
+        conversation was deleted in between. ``previous`` is what ``undo_turn``
+        needs to revert the turn: None if the turn created the conversation,
+        else its ``title`` and ``updated_at`` from before.
+        """
+
+    @abstractmethod
+    async def get_messages_json(self, user_id: str, conversation_id: str) -> Optional[list[bytes]]:
+        """All messages of a conversation as JSON, or None if it does not exist.
+
+        Each message is encoded once when stored, so reads never re-serialize.
+        """
+
+    @abstractmethod
+    async def history_lines(self, user_id: str, conversation_id: str) -> list[tuple[str, int]]:
+        """The recent ``"User: ..."`` / ``"Assistant: ..."`` lines, oldest first.
+
+        Each line comes with the token count of its message content.
+        """
+
+    @abstractmethod
+    async def list_conversations(self, user_id: str, limit: Optional[int] = None) -> list[dict]:
+        """Metadata of the ``limit`` (default all) most recently updated conversations."""
+
+    @abstractmethod
+    async def delete_conversation(self, user_id: str, conversation_id: str) -> bool:
+        """Delete a conversation; False if it did not exist."""
+
+    @abstractmethod
+    async def clear_messages(self, user_id: str, conversation_id: str) -> bool:
+        """Drop every message but keep the conversation; False if missing."""
+
+    @abstractmethod
+    async def undo_turn(
+        self, user_id: str, conversation_id: str, message_count: int, previous: Optional[dict]
+    ) -> bool:
+        """Revert a ``start_turn`` that returned ``message_count`` and ``previous``.
+
+        Used when a turn fails after its user message was stored. A
+        conversation the turn created is deleted; otherwise the message is
+        dropped and the title, ``updated_at`` and list position restored. Does
+        nothing and returns False if the conversation is missing or has
+        changed since. A history line that the message pushed out of the
+        window stays lost.
+        """
+
+    @abstractmethod
+    async def stats(self) -> dict[str, int]:
+        """``total_conversations``, ``total_messages`` and ``active_users``."""
+
+
+class _UserLock:
+    # threading.Lock cannot be weakly referenced, so hold it in a thin wrapper
+    __slots__ = ("_lock", "__weakref__")
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "_UserLock":
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._lock.release()
+
+
+class InMemoryConversationStore(ConversationStore):
+    """Process-local store. Contention is per user: each user has their own lock.
+
+    With ``max_conversations`` set, creating a conversation past the cap
+    evicts the least recently used one (across all users).
+    """
+
+    def __init__(self, history_window: int = 10, max_conversations: Optional[int] = None) -> None:
+        super().__init__(history_window)
+        self._users: dict[str, _UserConversations] = {}
+        # A user's lock lives only while some request holds it
+        self._locks: "weakref.WeakValueDictionary[str, _UserLock]" = weakref.WeakValueDictionary()
+        self._locks_guard = threading.Lock()
+        # Running totals so admin stats never walk every conversation
+        self._stats_lock = threading.Lock()
+        self._total_conversations = 0
+        self._total_messages = 0
+        self._active_users = 0
+        # Every (user_id, conversation_id), least recently used first
+        self._max_conversations = max_conversations
+        self._recency: OrderedDict[tuple[str, str], None] = OrderedDict()
+        self._recency_lock = threading.Lock()
+
+    def _lock_for(self, user_id: str) -> _UserLock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            with self._locks_guard:
+                lock = self._locks.get(user_id)
+                if lock is None:
+                    lock = self._locks[user_id] = _UserLock()
+        return lock
+
+    def _get_user_conversations(self, user_id: str) -> _UserConversations:
+        # Created on first write
+        conversations = self._users.get(user_id)
+        if conversations is None:
+            conversations = self._users.setdefault(user_id, OrderedDict())
+        return conversations
+
+    def _touch(self, user_id: str, conversation_id: str) -> None:
+        key = (user_id, conversation_id)
+        with self._recency_lock:
+            self._recency[key] = None
+            self._recency.move_to_end(key)
+
+    def _evict_if_needed(self) -> None:
+        if self._max_conversations is None:
+            return
+        while True:
+            with self._recency_lock:
+                if len(self._recency) <= self._max_conversations:
+                    return
+                (user_id, conversation_id), _ = self._recency.popitem(last=False)
+            self._delete(user_id, conversation_id)
+
+    def _delete(
+        self, user_id: str, conversation_id: str, expected_count: Optional[int] = None
+    ) -> bool:
+        """Delete a conversation; with ``expected_count``, only if it still has that many."""
+        with self._lock_for(user_id):
+            conversations = self._users.get(user_id, _NO_CONVERSATIONS)
+            conversation = conversations.get(conversation_id)
+            if conversation is None or (
+                expected_count is not None and conversation.meta["message_count"] != expected_count
+            ):
+                return False
+            del conversations[conversation_id]
+            last_conversation = not conversations
+            if last_conversation:
+                # Don't keep empty maps around for users who left
+                self._users.pop(user_id, None)
+        with self._recency_lock:
+            self._recency.pop((user_id, conversation_id), None)
+        self._bump(
+            conversations=-1,
+            messages=-conversation.meta["message_count"],
+            active_users=-1 if last_conversation else 0,
+        )
+        return True
+
+    def _bump(self, conversations: int = 0, messages: int = 0, active_users: int = 0) -> None:
+        with self._stats_lock:
+            self._total_conversations += conversations
+            self._total_messages += messages
+            self._active_users += active_users
+
+    # The *_locked helpers take the user's conversations, already looked up,
+    # and must be called with the user's lock held.
+
+    def _create_locked(self, conversations: _UserConversations, first_message: str) -> tuple[str, bool]:
+        """Add a conversation; returns its id and whether it is the user's first."""
+        conversation_id = fast_uuid4()
+        now_iso = _utcnow().isoformat()
+        conversations[conversation_id] = _Conversation({
+            "id": conversation_id,
+            "title": _derive_title(first_message),
+            "created_at": now_iso,
+            "updated_at": now_iso,
+            "message_count": 0,
+        }, self.history_window)
+        conversations.move_to_end(conversation_id, last=False)
+        return conversation_id, len(conversations) == 1
+
+    def _append_locked(
+        self,
+        conversations: _UserConversations,
+        conversation_id: str,
+        role: Role,
+        content: str,
+        n_tokens: int,
+    ) -> Optional[tuple[dict, int]]:
+        conversation = conversations.get(conversation_id)
+        if conversation is None:
+            return None
+
+        now_iso = _utcnow().isoformat()
+        message = {
+            "id": fast_uuid4(),
+            "content": content,
+            "role": role,
+            "timestamp": now_iso,
+            "conversationId": conversation_id,
+        }
+        conversation.messages_json.append(orjson.dumps(message))
+        conversation.history.append((_history_line(role, content), n_tokens))
+
+        meta = conversation.meta
+        meta["updated_at"] = now_iso
+        meta["message_count"] += 1
+        conversations.move_to_end(conversation_id, last=False)
+        if role == "user" and (not meta.get("title") or meta["title"] == "New Conversation"):
+            meta["title"] = _derive_title(content)
+        return message, meta["message_count"]
+
+    @staticmethod
+    def _reposition_locked(conversations: _UserConversations, conversation_id: str) -> None:
+        """Move a conversation back to the place its ``updated_at`` sorts to."""
+        updated_at = conversations[conversation_id].meta["updated_at"]
+        older = [
+            other_id
+            for other_id, other in conversations.items()
+            if other_id != conversation_id and other.meta["updated_at"] < updated_at
+        ]
+        # Most recent first: it goes behind the newer ones, the older follow
+        conversations.move_to_end(conversation_id)
+        for other_id in older:
+            conversations.move_to_end(other_id)
+
+    async def ensure_conversation(
+        self, user_id: str, conversation_id: Optional[str], first_message: str
+    ) -> str:
+        with self._lock_for(user_id):
+            conversations = self._get_user_conversations(user_id)
+            created = not (conversation_id and conversation_id in conversations)
+            if created:
+                conversation_id, first_conversation = self._create_locked(conversations, first_message)
+
+        self._touch(user_id, conversation_id)
+        if created:
+            self._bump(conversations=1, active_users=1 if first_conversation else 0)
+            # Outside the user's lock: the evicted conversation may be theirs
+            self._evict_if_needed()
+        return conversation_id
+
+    async def append_message(
+        self, user_id: str, conversation_id: str, role: Role, content: str, n_tokens: int
+    ) -> Optional[tuple[dict, int]]:
+        with self._lock_for(user_id):
+            stored = self._append_locked(
+                self._users.get(user_id, _NO_CONVERSATIONS), conversation_id, role, content, n_tokens
+            )
+        if stored is not None:
+            self._touch(user_id, conversation_id)
+            self._bump(messages=1)
+        return stored
+
+    async def start_turn(
+        self, user_id: str, conversation_id: Optional[str], content: str, n_tokens: int
+    ) -> Optional[tuple[str, int, Optional[dict]]]:
+        # One lock and one lookup of the user's conversations for both steps
+        with self._lock_for(user_id):
+            conversations = self._get_user_conversations(user_id)
+            created = not (conversation_id and conversation_id in conversations)
+            first_conversation = False
+            previous = None
+            if created:
+                conversation_id, first_conversation = self._create_locked(conversations, content)
+            else:
+                meta = conversations[conversation_id].meta
+                previous = {"title": meta["title"], "updated_at": meta["updated_at"]}
+            _, message_count = self._append_locked(
+                conversations, conversation_id, "user", content, n_tokens
+            )
+
+        self._touch(user_id, conversation_id)
+        self._bump(
+            conversations=1 if created else 0,
+            messages=1,
+            active_users=1 if first_conversation else 0,
+        )
+        if created:
+            self._evict_if_needed()
+        return conversation_id, message_count, previous
+
+    async def get_messages_json(self, user_id: str, conversation_id: str) -> Optional[list[bytes]]:
+        conversation = self._users.get(user_id, _NO_CONVERSATIONS).get(conversation_id)
+        if conversation is None:
+            return None
+        self._touch(user_id, conversation_id)
+        return conversation.messages_json
+
+    async def history_lines(self, user_id: str, conversation_id: str) -> list[tuple[str, int]]:
+        with self._lock_for(user_id):
+            conversation = self._users.get(user_id, _NO_CONVERSATIONS).get(conversation_id)
+            return [] if conversation is None else list(conversation.history)
+
+    async def list_conversations(self, user_id: str, limit: Optional[int] = None) -> list[dict]:
+        with self._lock_for(user_id):
+            # Already in recency order, so the top K is just the first K
+            conversations = self._users.get(user_id, _NO_CONVERSATIONS).values()
+            return [c.meta for c in itertools.islice(conversations, limit)]
+
+    async def delete_conversation(self, user_id: str, conversation_id: str) -> bool:
+        return self._delete(user_id, conversation_id)
+
+    async def clear_messages(self, user_id: str, conversation_id: str) -> bool:
+        with self._lock_for(user_id):
+            conversations = self._users.get(user_id, _NO_CONVERSATIONS)
+            conversation = conversations.get(conversation_id)
+            if conversation is None:
+                return False
+            meta = conversation.meta
+            cleared = meta["message_count"]
+            # A new list: readers may still hold the old one
+            conversation.messages_json = []
+            conversation.history.clear()
+            meta["updated_at"] = _utcnow().isoformat()
+            meta["message_count"] = 0
+            conversations.move_to_end(conversation_id, last=False)
+        self._touch(user_id, conversation_id)
+        self._bump(messages=-cleared)
+        return True
+
+    async def undo_turn(
+        self, user_id: str, conversation_id: str, message_count: int, previous: Optional[dict]
+    ) -> bool:
+        if previous is None:
+            return self._delete(user_id, conversation_id, message_count)
+
+        with self._lock_for(user_id):
+            conversations = self._users.get(user_id, _NO_CONVERSATIONS)
+            conversation = conversations.get(conversation_id)
+            if conversation is None or conversation.meta["message_count"] != message_count:
+                return False
+            # A new list: readers may still hold the old one
+            conversation.messages_json = conversation.messages_json[:-1]
+            if conversation.history:
+                conversation.history.pop()
+            meta = conversation.meta
+            meta["message_count"] -= 1
+            meta["title"] = previous["title"]
+            meta["updated_at"] = previous["updated_at"]
+            self._reposition_locked(conversations, conversation_id)
+        self._bump(messages=-1)
+        return True
+
+    async def stats(self) -> dict[str, int]:
+        return {
+            "total_conversations": self._total_conversations,
+            "total_messages": self._total_messages,
+            "active_users": self._active_users,
+        }
+
+
+class RedisConversationStore(ConversationStore):
+    """Store shared by every worker, on ``redis.asyncio``.
+
+    Keys, under ``prefix``:
+      ``conv:{user}:{id}``       hash of the conversation metadata
+      ``conv:{user}:{id}:msgs``  list of JSON-encoded messages
+      ``conv:{user}:{id}:hist``  recent history lines, JSON ``[line, tokens]``
+      ``convs:{user}``           sorted set of conversation ids by updated_at
+      ``stats`` / ``active_users``  admin counters and users with conversations
+
+    Messages and history lines of the ``l1_size`` most recently read
+    conversations are also kept in process. Every write publishes the
+    conversation key on ``{prefix}invalidate`` and each worker drops its copy,
+    so reads never hit Redis for a conversation nobody has written to since.
+    """
+
+    def __init__(
+        self, url: str, prefix: str = "chat:", history_window: int = 10, l1_size: int = 512
+    ) -> None:
+        super().__init__(history_window)
+        # Optional dependency, only needed when a Redis URL is configured
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._watch_error = redis.WatchError
+        self._prefix = prefix
+        self._stats_key = f"{prefix}stats"
+        self._active_key = f"{prefix}active_users"
+        self._invalidate_channel = f"{prefix}invalidate"
+        # (conversation key, "msgs" | "hist") -> value, least recently read first
+        self._l1: "OrderedDict[tuple[str, str], list]" = OrderedDict()
+        self._l1_size = l1_size
+        # Bumped on every invalidation; a read only fills L1 if it did not move
+        # while Redis was queried, or it could cache what a write just replaced
+        self._l1_epoch = 0
+        # L1 is only used while subscribed, otherwise other workers' writes
+        # would go unnoticed
+        self._l1_live = False
+        self._listener: Optional[asyncio.Task] = None
+
+    def _conv_key(self, user_id: str, conversation_id: str) -> str:
+        return f"{self._prefix}conv:{user_id}:{conversation_id}"
+
+    def _index_key(self, user_id: str) -> str:
+        return f"{self._prefix}convs:{user_id}"
+
+    def _ensure_listener(self) -> None:
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self) -> None:
+        pubsub = self._redis.pubsub()
+        try:
+            await pubsub.subscribe(self._invalidate_channel)
+            async for event in pubsub.listen():
+                if event["type"] == "subscribe":
+                    self._l1_live = True
+                elif event["type"] == "message":
+                    self._drop_l1(event["data"])
+        finally:
+            # Writes may be missed from here on; the next read resubscribes
+            self._l1_live = False
+            self._l1.clear()
+            await pubsub.aclose()
+
+    def _drop_l1(self, key: str) -> None:
+        self._l1_epoch += 1
+        self._l1.pop((key, "msgs"), None)
+        self._l1.pop((key, "hist"), None)
+
+    def _l1_get(self, key: str, kind: str) -> Optional[list]:
+        self._ensure_listener()
+        value = self._l1.get((key, kind))
+        if value is not None:
+            self._l1.move_to_end((key, kind))
+        return value
+
+    def _l1_put(self, key: str, kind: str, value: list, epoch: int) -> None:
+        if not self._l1_live or epoch != self._l1_epoch:
+            return
+        self._l1[(key, kind)] = value
+        if len(self._l1) > self._l1_size:
+            self._l1.popitem(last=False)
+
+    def _invalidate(self, pipe, key: str) -> None:
+        """Drop ``key`` from this worker's L1 and queue the broadcast on ``pipe``."""
+        self._drop_l1(key)
+        pipe.publish(self._invalidate_channel, key)
+
+    async def _transaction(self, watch: tuple[str, ...], read, queue) -> Optional[list]:
+        """Optimistic read-modify-write of the ``watch`` keys.
+
+        ``await read(pipe)`` reads current state while the keys are watched
+        (None aborts and is returned); ``queue(pipe, state)`` then queues the
+        writes, which run in one MULTI/EXEC. If another client wrote a
+        watched key in between, EXEC fails and both steps are retried, so
+        concurrent workers never act on a stale count.
+        """
+        async with self._redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(*watch)
+                    state = await read(pipe)
+                    if state is None:
+                        return None
+                    pipe.multi()
+                    queue(pipe, state)
+                    return await pipe.execute()
+                except self._watch_error:
+                    continue
+
+    async def ensure_conversation(
+        self, user_id: str, conversation_id: Optional[str], first_message: str
+    ) -> str:
+        if conversation_id and await self._redis.exists(self._conv_key(user_id, conversation_id)):
+            return conversation_id
+        return await self._create(user_id, first_message)
+
+    async def _create(self, user_id: str, first_message: str) -> str:
+        conv_id = fast_uuid4()
+        now = _utcnow()
+        now_iso = now.isoformat()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._conv_key(user_id, conv_id), mapping={
+                "title": _derive_title(first_message),
+                "created_at": now_iso,
+                "updated_at": now_iso,
+                "message_count": 0,
+            })
+            pipe.zadd(self._index_key(user_id), {conv_id: now.timestamp()})
+            pipe.hincrby(self._stats_key, "total_conversations", 1)
+            pipe.sadd(self._active_key, user_id)
+            await pipe.execute()
+        return conv_id
+
+    async def append_message(
+        self, user_id: str, conversation_id: str, role: Role, content: str, n_tokens: int
+    ) -> Optional[tuple[dict, int]]:
+        stored = await self._append(user_id, conversation_id, role, content, n_tokens)
+        return None if stored is None else stored[:2]
+
+    async def start_turn(
+        self, user_id: str, conversation_id: Optional[str], content: str, n_tokens: int
+    ) -> Optional[tuple[str, int, Optional[dict]]]:
+        created = not (
+            conversation_id and await self._redis.exists(self._conv_key(user_id, conversation_id))
+        )
+        if created:
+            conversation_id = await self._create(user_id, content)
+        stored = await self._append(user_id, conversation_id, "user", content, n_tokens)
+        if stored is None:
+            return None
+        _, message_count, previous = stored
+        return conversation_id, message_count, None if created else previous
+
+    async def _append(
+        self, user_id: str, conversation_id: str, role: Role, content: str, n_tokens: int
+    ) -> Optional[tuple[dict, int, dict]]:
+        """``append_message``, also returning the title and updated_at it replaced."""
+        key = self._conv_key(user_id, conversation_id)
+        now = _utcnow()
+        now_iso = now.isoformat()
+        message = {
+            "id": fast_uuid4(),
+            "content": content,
+            "role": role,
+            "timestamp": now_iso,
+            "conversationId": conversation_id,
+        }
+
+        previous = {}
+
+        async def read(pipe) -> Optional[tuple[str, str]]:
+            title, updated_at = await pipe.hmget(key, "title", "updated_at")
+            return None if title is None else (title, updated_at)
+
+        def queue(pipe, state: tuple[str, str]) -> None:
+            title, updated_at = state
+            previous.update(title=title, updated_at=updated_at)
+            pipe.hincrby(key, "message_count", 1)
+            pipe.rpush(f"{key}:msgs", orjson.dumps(message))
+            pipe.rpush(f"{key}:hist", orjson.dumps((_history_line(role, content), n_tokens)))
+            pipe.ltrim(f"{key}:hist", -self.history_window, -1)
+            pipe.hset(key, "updated_at", now_iso)
+            if role == "user" and (not title or title == "New Conversation"):
+                pipe.hset(key, "title", _derive_title(content))
+            pipe.zadd(self._index_key(user_id), {conversation_id: now.timestamp()})
+            pipe.hincrby(self._stats_key, "total_messages", 1)
+            self._invalidate(pipe, key)
+
+        # Under WATCH, a conversation deleted or appended to concurrently is
+        # re-read instead of being half-recreated or counted twice
+        results = await self._transaction((key,), read, queue)
+        if results is None:
+            return None
+        return message, results[0], previous
+
+    async def get_messages_json(self, user_id: str, conversation_id: str) -> Optional[list[bytes]]:
+        key = self._conv_key(user_id, conversation_id)
+        messages_json = self._l1_get(key, "msgs")
+        if messages_json is not None:
+            return messages_json
+
+        epoch = self._l1_epoch
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.exists(key)
+            pipe.lrange(f"{key}:msgs", 0, -1)
+            exists, raw = await pipe.execute()
+        if not exists:
+            return None
+        # Stored JSON-encoded already; hand it back without decoding
+        messages_json = [m.encode() for m in raw]
+        self._l1_put(key, "msgs", messages_json, epoch)
+        return messages_json
+
+    async def history_lines(self, user_id: str, conversation_id: str) -> list[tuple[str, int]]:
+        key = self._conv_key(user_id, conversation_id)
+        history = self._l1_get(key, "hist")
+        if history is None:
+            epoch = self._l1_epoch
+            history = [tuple(orjson.loads(h)) for h in await self._redis.lrange(f"{key}:hist", 0, -1)]
+            self._l1_put(key, "hist", history, epoch)
+        return list(history)
+
+    async def list_conversations(self, user_id: str, limit: Optional[int] = None) -> list[dict]:
+        end = -1 if limit is None else limit - 1
+        conv_ids = await self._redis.zrevrange(self._index_key(user_id), 0, end)
+        if not conv_ids:
+            return []
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for conv_id in conv_ids:
+                pipe.hgetall(self._conv_key(user_id, conv_id))
+            metas = await pipe.execute()
+        return [
+            {**meta, "id": conv_id, "message_count": int(meta["message_count"])}
+            for conv_id, meta in zip(conv_ids, metas)
+            if meta
+        ]
+
+    async def delete_conversation(self, user_id: str, conversation_id: str) -> bool:
+        return await self._delete(user_id, conversation_id)
+
+    async def _delete(
+        self, user_id: str, conversation_id: str, expected_count: Optional[int] = None
+    ) -> bool:
+        """Delete a conversation; with ``expected_count``, only if it still has that many."""
+        key = self._conv_key(user_id, conversation_id)
+        index_key = self._index_key(user_id)
+
+        async def read(pipe) -> Optional[tuple[str, int]]:
+            message_count = await pipe.hget(key, "message_count")
+            if message_count is None or (
+                expected_count is not None and int(message_count) != expected_count
+            ):
+                return None
+            return message_count, await pipe.zcard(index_key)
+
+        def queue(pipe, state: tuple[str, int]) -> None:
+            message_count, n_conversations = state
+            pipe.delete(key, f"{key}:msgs", f"{key}:hist")
+            pipe.zrem(index_key, conversation_id)
+            pipe.hincrby(self._stats_key, "total_conversations", -1)
+            pipe.hincrby(self._stats_key, "total_messages", -int(message_count))
+            # The index is watched too, so a conversation created meanwhile
+            # keeps the user active
+            if n_conversations <= 1:
+                pipe.srem(self._active_key, user_id)
+            self._invalidate(pipe, key)
+
+        return await self._transaction((key, index_key), read, queue) is not None
+
+    async def clear_messages(self, user_id: str, conversation_id: str) -> bool:
+        key = self._conv_key(user_id, conversation_id)
+        now = _utcnow()
+
+        async def read(pipe) -> Optional[str]:
+            return await pipe.hget(key, "message_count")
+
+        def queue(pipe, message_count: str) -> None:
+            pipe.delete(f"{key}:msgs", f"{key}:hist")
+            pipe.hset(key, mapping={"updated_at": now.isoformat(), "message_count": 0})
+            pipe.zadd(self._index_key(user_id), {conversation_id: now.timestamp()})
+            pipe.hincrby(self._stats_key, "total_messages", -int(message_count))
+            self._invalidate(pipe, key)
+
+        return await self._transaction((key,), read, queue) is not None
+
+    async def undo_turn(
+        self, user_id: str, conversation_id: str, message_count: int, previous: Optional[dict]
+    ) -> bool:
+        if previous is None:
+            return await self._delete(user_id, conversation_id, message_count)
+
+        key = self._conv_key(user_id, conversation_id)
+
+        async def read(pipe) -> Optional[bool]:
+            current = await pipe.hget(key, "message_count")
+            return True if current is not None and int(current) == message_count else None
+
+        def queue(pipe, _) -> None:
+            pipe.rpop(f"{key}:msgs")
+            pipe.rpop(f"{key}:hist")
+            pipe.hincrby(key, "message_count", -1)
+            pipe.hset(key, mapping=previous)
+            # Back to its old place in the recency index
+            updated = datetime.fromisoformat(previous["updated_at"]).timestamp()
+            pipe.zadd(self._index_key(user_id), {conversation_id: updated})
+            pipe.hincrby(self._stats_key, "total_messages", -1)
+            self._invalidate(pipe, key)
+
+        return await self._transaction((key,), read, queue) is not None
+
+    async def stats(self) -> dict[str, int]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self._stats_key, "total_conversations", "total_messages")
+            pipe.scard(self._active_key)
+            (conversations, messages), active_users = await pipe.execute()
+        return {
+            "total_conversations": int(conversations or 0),
+            "total_messages": int(messages or 0),
+            "active_users": active_users,
+        }
@@ -1,9 +1,27 @@
 # backend/llm_model.py
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    DynamicCache,
+    GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+import asyncio
+import copy
+import functools
+import importlib.util
 import os
 import sys
+import threading
+
+from backend.tokenization import continuation_ids
 
 print("[llm_model] sys.executable:", sys.executable)
 print("[llm_model] CUDA_VISIBLE_DEVICES:",
@@ -16,9 +34,21 @@ print("[llm_model] torch.cuda.is_available():", torch.cuda.is_available())
 # Small but modern chat model
 MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
 
+# Weight-only quantization on CUDA: "nf4" (default), "int8" or "none".
+# Decode is memory-bound, so fewer bytes per weight means faster tokens.
+QUANTIZATION = os.getenv("LLM_QUANTIZATION", "nf4").lower()
+
 if torch.cuda.is_available():
     DEVICE = "cuda"
     MODEL_KWARGS = {"torch_dtype": torch.float16}
+    if QUANTIZATION == "nf4":
+        MODEL_KWARGS["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,  # activations stay FP16
+            bnb_4bit_quant_type="nf4",
+        )
+    elif QUANTIZATION == "int8":
+        MODEL_KWARGS["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
 elif getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
     DEVICE = "mps"
     MODEL_KWARGS = {"torch_dtype": torch.float16}
@@ -26,7 +56,76 @@ else:
     DEVICE = "cpu"
     MODEL_KWARGS = {}
 
+
+def _cpu_has_native_bf16() -> bool:
+    """True if the CPU executes BF16 math natively (AVX512_BF16 or AMX).
+
+    Plain AVX-512 (Skylake through Ice Lake Xeons) only emulates BF16, which
+    is slower than staying in FP32.
+    """
+    return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+
+
+# On CPU, Intel Extension for PyTorch (optional install) runs the linear
+# layers on AMX/VNNI kernels. BF16 weights halve the bytes read per decode
+# step, but only pay off where the hardware has native BF16 instructions.
+USE_IPEX = (
+    DEVICE == "cpu"
+    and importlib.util.find_spec("intel_extension_for_pytorch") is not None
+)
+if DEVICE == "cpu" and _cpu_has_native_bf16():
+    MODEL_KWARGS["torch_dtype"] = torch.bfloat16
+
+# Upper bound on tokens kept in a reused conversation KV cache. Past this the
+# cache is dropped and the next turn re-prefills a fresh history window.
+KV_CACHE_MAX_TOKENS = int(os.getenv("LLM_KV_CACHE_MAX_TOKENS", "1536"))
+
+# Hard cap on prompt tokens; longer prompts lose their oldest tokens. Leaves
+# room for the reply inside TinyLlama's 2048-token window.
+MAX_CONTEXT_TOKENS = int(os.getenv("LLM_MAX_CONTEXT_TOKENS", "1920"))
+
+# torch.compile + CUDA graphs (CUDA only, opt-in: compiling takes a while at
+# startup). Prompts are padded to a multiple of PAD_TO_MULTIPLE_OF tokens so
+# the captured graphs are reused instead of recompiled for every length.
+TORCH_COMPILE = (
+    DEVICE == "cuda"
+    and os.getenv("LLM_TORCH_COMPILE", "false").lower() == "true"
+)
+PAD_TO_MULTIPLE_OF = 64
+
+# Compiled and IPEX-optimized models manage their own KV cache layout, so
+# HF DynamicCache objects can't be carried between calls.
+REUSE_KV_CACHE = not (TORCH_COMPILE or USE_IPEX)
+
+# Dynamic micro-batching: cold prompts arriving within LLM_BATCH_MAX_WAIT_MS
+# of each other share one generate call (up to LLM_BATCH_SIZE prompts). Decode
+# is memory-bound, so a batch costs about the same per step as one prompt.
+BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.getenv("LLM_BATCH_MAX_WAIT_MS", "10"))
+
+# Speculative decoding (opt-in): a small draft model sharing the tokenizer
+# proposes LLM_NUM_ASSISTANT_TOKENS tokens that the main model verifies in a
+# single forward pass. Greedy replies stay identical to plain decoding. HF
+# only supports it for single-row, non-compiled generate calls.
+ASSISTANT_MODEL_NAME = os.getenv("LLM_ASSISTANT_MODEL")
+NUM_ASSISTANT_TOKENS = int(os.getenv("LLM_NUM_ASSISTANT_TOKENS", "5"))
+USE_ASSISTANT = bool(ASSISTANT_MODEL_NAME) and not (TORCH_COMPILE or USE_IPEX)
+
+# Fused attention kernels instead of the eager N x N attention matrix.
+# FlashAttention-2 needs CUDA and the optional flash-attn package; PyTorch's
+# SDPA kernels work everywhere else.
+if DEVICE == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+    MODEL_KWARGS["attn_implementation"] = "flash_attention_2"
+else:
+    MODEL_KWARGS["attn_implementation"] = "sdpa"
+
 print(f"[llm_model] Using device: {DEVICE}")
+print(f"[llm_model] Using dtype: {MODEL_KWARGS.get('torch_dtype', torch.float32)}")
+print(f"[llm_model] Using attention: {MODEL_KWARGS['attn_implementation']}")
+if "quantization_config" in MODEL_KWARGS:
+    print(f"[llm_model] Using bitsandbytes quantization: {QUANTIZATION}")
+if USE_ASSISTANT:
+    print(f"[llm_model] Using assistant model: {ASSISTANT_MODEL_NAME}")
 
 # Use fast tokenizer (no sentencepiece python package needed)
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
@@ -35,13 +134,185 @@ tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
 if tokenizer.pad_token is None:
     tokenizer.pad_token = tokenizer.eos_token
 
+# Left padding keeps the last prompt token of every batch row aligned, which
+# is where decoding continues from. Truncation also drops from the left so
+# the latest turn always survives.
+tokenizer.padding_side = "left"
+tokenizer.truncation_side = "left"
+
 # Load the model in standard precision
 # If you have GPU, you can use float16; otherwise default dtype is fine.
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME, **MODEL_KWARGS).to(DEVICE)
+if "quantization_config" in MODEL_KWARGS:
+    # bitsandbytes places quantized weights itself; calling .to() on them fails.
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME, device_map={"": DEVICE}, **MODEL_KWARGS)
+else:
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME, **MODEL_KWARGS).to(DEVICE)
 
 model.eval()
 
+if USE_IPEX:
+    import intel_extension_for_pytorch as ipex
+
+    print("[llm_model] Optimizing model with Intel Extension for PyTorch")
+    model = ipex.llm.optimize(
+        model, dtype=MODEL_KWARGS.get("torch_dtype", torch.float32))
+
+if TORCH_COMPILE:
+    print("[llm_model] Compiling model with torch.compile (reduce-overhead)")
+    # Compiled graphs need fixed-size tensors, so use HF's static KV cache
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(
+        model.forward, mode="reduce-overhead", fullgraph=True)
+
+assistant_model = None
+if USE_ASSISTANT:
+    # Unquantized in the main model's dtype; it is small enough already
+    assistant_model = AutoModelForCausalLM.from_pretrained(
+        ASSISTANT_MODEL_NAME,
+        torch_dtype=MODEL_KWARGS.get("torch_dtype"),
+        attn_implementation=MODEL_KWARGS["attn_implementation"],
+    ).to(DEVICE)
+    assistant_model.eval()
+    assistant_model.generation_config.num_assistant_tokens = NUM_ASSISTANT_TOKENS
+
+
+# Token ids reach the GPU from pinned host memory, so the copy is queued
+# asynchronously instead of blocking on a pageable-memory transfer.
+PIN_MEMORY = DEVICE == "cuda"
+
+# Pinned staging buffers for batched prompts, allocated once at
+# BATCH_SIZE x MAX_CONTEXT_TOKENS. Only generate_batch uses them, and the
+# batch worker runs one generate call at a time.
+_pinned_staging: dict[str, torch.Tensor] = {}
+
+
+def _to_device(tensor: torch.Tensor, staging_key: str | None = None) -> torch.Tensor:
+    if not PIN_MEMORY:
+        return tensor.to(DEVICE)
+
+    if staging_key is not None and tensor.numel() <= BATCH_SIZE * MAX_CONTEXT_TOKENS:
+        buffer = _pinned_staging.get(staging_key)
+        if buffer is None:
+            buffer = _pinned_staging[staging_key] = torch.empty(
+                BATCH_SIZE * MAX_CONTEXT_TOKENS, dtype=tensor.dtype, pin_memory=True)
+        pinned = buffer[:tensor.numel()].view_as(tensor)
+        pinned.copy_(tensor)
+    else:
+        pinned = tensor.pin_memory()
+    return pinned.to(DEVICE, non_blocking=True)
+
+
+def _encode(text: str | list[str], add_special_tokens: bool = True) -> dict:
+    """Tokenize onto DEVICE, padding batches (and buckets when compiled)."""
+    inputs = tokenizer(
+        text,
+        return_tensors="pt",
+        add_special_tokens=add_special_tokens,
+        padding=True,
+        pad_to_multiple_of=PAD_TO_MULTIPLE_OF if TORCH_COMPILE else None,
+        truncation=True,
+        max_length=MAX_CONTEXT_TOKENS,
+    )
+    staged = isinstance(text, list)
+    return {
+        name: _to_device(tensor, name if staged else None)
+        for name, tensor in inputs.items()
+    }
+
+
+def count_tokens(text: str) -> int:
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def cache_fits(cache: dict, new_tokens: int, max_new_tokens: int) -> bool:
+    """Whether ``new_tokens`` plus a reply still fit after the cached turns."""
+    return (
+        cache["input_ids"].shape[1] + new_tokens + max_new_tokens
+        <= MAX_CONTEXT_TOKENS
+    )
+
+
+# Greedy decoding never reads these, and leaving them set on the model's
+# generation config would keep HF constructing sampling warpers for it.
+model.generation_config.temperature = None
+model.generation_config.top_p = None
+
+
+@functools.lru_cache(maxsize=32)
+def _generation_config(
+    do_sample: bool, temperature: float, top_p: float, repetition_penalty: float
+) -> GenerationConfig:
+    """Generation config for one set of decoding settings, built once.
+
+    Callers reuse the same few settings, so generate gets a ready config
+    instead of merging loose kwargs into a new one on every call. Greedy
+    configs have no temperature/top_p, so no sampling logits warpers are
+    built and run on every decode step.
+    """
+    # Start from the model's own config to keep e.g. the static cache setting
+    config = copy.deepcopy(model.generation_config)
+    if do_sample:
+        config.update(
+            do_sample=True,
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    else:
+        config.update(
+            do_sample=False,
+            num_beams=1,
+            repetition_penalty=repetition_penalty,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    return config
+
+
+def _assisted_kwargs(do_sample: bool) -> dict:
+    """Draft model for single-prompt greedy calls, when one is loaded."""
+    if assistant_model is None or do_sample:
+        return {}
+    return {"assistant_model": assistant_model}
+
+
+# Static prompt prefixes prefilled once; prompts that start with one begin
+# from a copy of its KV cache instead of re-prefilling the same tokens.
+_prefix_caches: list[tuple[torch.Tensor, DynamicCache]] = []
+
+
+def cache_prefix(text: str) -> None:
+    """Precompute the KV cache for a static prompt prefix."""
+    if not REUSE_KV_CACHE:
+        return
+
+    # The last token is left out: it can merge with whatever text follows,
+    # and a cached prefix is only used when the tokens match exactly.
+    ids = _to_device(tokenizer(text, return_tensors="pt").input_ids[:, :-1])
+    with torch.no_grad():
+        past_key_values = model(
+            input_ids=ids, past_key_values=DynamicCache(), use_cache=True
+        ).past_key_values
+    _prefix_caches.append((ids, past_key_values))
+
+
+def _prefix_cache_for(input_ids: torch.Tensor) -> DynamicCache:
+    """Fresh cache seeded with a registered prefix of ``input_ids``, if any."""
+    for ids, past_key_values in _prefix_caches:
+        n = ids.shape[1]
+        if input_ids.shape[1] > n and torch.equal(input_ids[0, :n], ids[0]):
+            # generate extends the cache in place, so hand out a copy
+            return copy.deepcopy(past_key_values)
+    return DynamicCache()
+
+
+QA_SYSTEM_INSTRUCTION = (
+    "You are a helpful, knowledgeable AI assistant. "
+    "Answer the following question clearly and concisely."
+)
+
 
 def generate_text(
     prompt: str,
@@ -51,19 +322,13 @@ def generate_text(
     do_sample: bool = True,
     repetition_penalty: float = 1.05,
     wrap_prompt: bool = True,   # when False, use prompt as-is (for chat history)
-    strip_after: str | None = None,  # if provided, trim decoded text after this marker
 ) -> str:
     if not prompt:
         raise ValueError("Prompt must not be empty.")
 
     if wrap_prompt:
-        system_instruction = (
-            "You are a helpful, knowledgeable AI assistant. "
-            "Answer the following question clearly and concisely."
-        )
-
         full_prompt = (
-            system_instruction
+            QA_SYSTEM_INSTRUCTION
             + "\n\nQuestion:\n"
             + prompt.strip()
             + "\n\nAnswer:"
@@ -71,25 +336,322 @@ def generate_text(
     else:
         full_prompt = prompt.strip()
 
-    inputs = tokenizer(full_prompt, return_tensors="pt").to(DEVICE)
+    inputs = _encode(full_prompt)
+    if REUSE_KV_CACHE:
+        inputs["past_key_values"] = _prefix_cache_for(inputs["input_ids"])
 
     with torch.no_grad():
         output_ids = model.generate(
             **inputs,
+            use_cache=True,
+            return_dict_in_generate=False,
             max_new_tokens=max_new_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            do_sample=do_sample,
-            repetition_penalty=repetition_penalty,
-            pad_token_id=tokenizer.pad_token_id,
+            generation_config=_generation_config(
+                do_sample, temperature, top_p, repetition_penalty),
+            **_assisted_kwargs(do_sample),
+        )
+
+    # Decode only the generated tail; the prompt never needs to be decoded
+    # and split back off.
+    input_len = inputs["input_ids"].shape[1]
+    return tokenizer.decode(
+        output_ids[0, input_len:], skip_special_tokens=True
+    ).strip()
+
+
+def generate_with_cache(
+    prompt: str,
+    cache: dict | None = None,
+    max_new_tokens: int = 60,
+    temperature: float = 0.4,
+    top_p: float = 0.9,
+    do_sample: bool = True,
+    repetition_penalty: float = 1.05,
+    streamer: TextIteratorStreamer | None = None,
+    stopping_criteria: StoppingCriteriaList | None = None,
+) -> tuple[str, dict | None]:
+    """Generate a reply, reusing the KV cache from earlier turns.
+
+    With ``cache=None`` the prompt is the full conversation prompt. Otherwise
+    it is only the new text to append after the cached sequence, so just those
+    tokens are prefilled (or, if appending it would re-tokenize the cached
+    text, the whole conversation is prefilled from scratch). Returns the reply and the cache for the next turn
+    (``None`` once it grows past ``KV_CACHE_MAX_TOKENS``, and always when the
+    model is compiled or IPEX-optimized). Text chunks are also pushed to
+    ``streamer`` as they are decoded, and ``stopping_criteria`` can end the
+    reply early.
+    """
+    if not prompt:
+        raise ValueError("Prompt must not be empty.")
+
+    if not REUSE_KV_CACHE:
+        # The model keeps its own per-call cache, so every turn is prefilled
+        # from the full prompt and no cache is handed back.
+        inputs = _encode(prompt)
+        with torch.no_grad():
+            output_ids = model.generate(
+                **inputs,
+                use_cache=True,
+                return_dict_in_generate=False,
+                max_new_tokens=max_new_tokens,
+                generation_config=_generation_config(
+                    do_sample, temperature, top_p, repetition_penalty),
+                **_assisted_kwargs(do_sample),
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+            )
+        reply = tokenizer.decode(
+            output_ids[0, inputs["input_ids"].shape[1]:], skip_special_tokens=True
         )
+        return reply.strip(), None
+
+    suffix_ids = None
+    if cache is not None:
+        suffix_ids = continuation_ids(tokenizer, cache["input_ids"][0].tolist(), prompt)
+        if suffix_ids is None:
+            # The join re-tokenizes the cached text, so its KV entries no
+            # longer match; prefill the whole conversation instead.
+            prompt = tokenizer.decode(
+                cache["input_ids"][0], skip_special_tokens=True,
+                clean_up_tokenization_spaces=False) + prompt
+            cache = None
+
+    if cache is None:
+        input_ids = _to_device(tokenizer(
+            prompt,
+            return_tensors="pt",
+            truncation=True,
+            max_length=MAX_CONTEXT_TOKENS,
+        ).input_ids)
+        past_key_values = _prefix_cache_for(input_ids)
+    else:
+        new_ids = _to_device(torch.tensor([suffix_ids], dtype=cache["input_ids"].dtype))
+        input_ids = torch.cat([cache["input_ids"], new_ids], dim=-1)
+        past_key_values = cache["past_key_values"]
+
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict_in_generate=True,
+            max_new_tokens=max_new_tokens,
+            generation_config=_generation_config(
+                do_sample, temperature, top_p, repetition_penalty),
+            **_assisted_kwargs(do_sample),
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+        )
+
+    sequences = output.sequences
+    reply = tokenizer.decode(
+        sequences[0, input_ids.shape[1]:], skip_special_tokens=True
+    )
+
+    # The last generated token is never in the cache, so a trailing EOS can be
+    # dropped to keep it out of the next turn's context.
+    if sequences[0, -1].item() == tokenizer.eos_token_id:
+        sequences = sequences[:, :-1]
+
+    if sequences.shape[1] > KV_CACHE_MAX_TOKENS:
+        return reply.strip(), None
+
+    return reply.strip(), {
+        "input_ids": sequences,
+        "past_key_values": output.past_key_values,
+    }
+
+
+
+def generate_batch(
+    prompts: list[str],
+    max_new_tokens: int = 60,
+    temperature: float = 0.4,
+    top_p: float = 0.9,
+    do_sample: bool = True,
+    repetition_penalty: float = 1.05,
+) -> list[str]:
+    """Generate replies for several full prompts in one padded forward pass."""
+    inputs = _encode(prompts)
+
+    with torch.no_grad():
+        output_ids = model.generate(
+            **inputs,
+            use_cache=True,
+            return_dict_in_generate=False,
+            max_new_tokens=max_new_tokens,
+            generation_config=_generation_config(
+                do_sample, temperature, top_p, repetition_penalty),
+        )
+
+    new_ids = output_ids[:, inputs["input_ids"].shape[1]:]
+    return [
+        text.strip()
+        for text in tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+    ]
+
+
+def make_streamer() -> TextIteratorStreamer:
+    """Streamer yielding decoded reply text chunks (prompt excluded)."""
+    return TextIteratorStreamer(
+        tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+
+class _StopOnEvent(StoppingCriteria):
+    """Ends generation once ``event`` is set, from any thread."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],), self.event.is_set(),
+            dtype=torch.bool, device=input_ids.device)
+
+
+_batch_queue: asyncio.Queue | None = None
+_batch_loop: asyncio.AbstractEventLoop | None = None
+
+# Model calls run on their own thread, not the loop's default executor.
+# Streamed turns park default-executor threads on streamer reads until their
+# generation runs, so with a shared pool enough concurrent streams could leave
+# no thread free to run it. The batch worker issues one call at a time, so a
+# single thread is all it needs.
+_generation_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="llm-generate")
+
+
+async def _run_generation(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _generation_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def enqueue(
+    prompt: str, cache: dict | None = None, **generation_kwargs
+) -> tuple[str, dict | None]:
+    """Submit a chat turn to the micro-batcher and wait for its reply.
+
+    Same contract as ``generate_with_cache``. Turns continuing a cached
+    conversation and streamed turns run on their own; cold prompts that arrive
+    together with the same generation settings are batched (and then hand
+    back no cache).
+    """
+    global _batch_queue, _batch_loop
+
+    if not prompt:
+        raise ValueError("Prompt must not be empty.")
+
+    loop = asyncio.get_running_loop()
+    if _batch_loop is not loop:
+        # Start (or restart, e.g. after a reload) the worker on this loop
+        _batch_queue = asyncio.Queue()
+        _batch_loop = loop
+        loop.create_task(_batch_worker(_batch_queue))
+
+    future = loop.create_future()
+    await _batch_queue.put((prompt, cache, generation_kwargs, future))
+    return await future
+
+
+async def _batch_worker(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await queue.get()]
+        deadline = loop.time() + BATCH_MAX_WAIT_MS / 1000
+        while len(items) < BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        await _run_batch(items)
+
+
+async def _run_batch(items: list[tuple]) -> None:
+    cold_groups: dict[tuple, list[tuple]] = {}
+    for item in items:
+        prompt, cache, generation_kwargs, future = item
+        if cache is None and "streamer" not in generation_kwargs:
+            key = tuple(sorted(generation_kwargs.items()))
+            cold_groups.setdefault(key, []).append(item)
+        else:
+            await _run_single(prompt, cache, generation_kwargs, future)
+
+    for group in cold_groups.values():
+        if len(group) == 1:
+            # A lone cold prompt still seeds the conversation's KV cache
+            await _run_single(*group[0])
+            continue
+
+        prompts = [item[0] for item in group]
+        try:
+            replies = await _run_generation(
+                generate_batch, prompts, **group[0][2])
+        except Exception as e:
+            for *_, future in group:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (*_, future), reply in zip(group, replies):
+                if not future.done():
+                    future.set_result((reply, None))
+
+
+async def _run_single(
+    prompt: str, cache: dict | None, generation_kwargs: dict, future: asyncio.Future
+) -> None:
+    try:
+        result = await _run_generation(
+            generate_with_cache, prompt, cache=cache, **generation_kwargs)
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+    else:
+        if not future.done():
+            future.set_result(result)
+
+
+def stream_text(
+    prompt: str, cache: dict | None = None, **generation_kwargs
+) -> tuple[AsyncIterator[str], asyncio.Future, Callable[[], None]]:
+    """Queue a chat turn and iterate its reply text as it is decoded.
+
+    Returns an async iterator of text chunks, the future of the
+    ``(reply, cache)`` result ``enqueue`` would return, and a function that
+    stops the generation (e.g. once the client has gone), which also ends
+    the iterator. Call it from the event loop.
+    """
+    streamer = make_streamer()
+    stop = threading.Event()
+    generation = asyncio.ensure_future(enqueue(
+        prompt, cache=cache, streamer=streamer,
+        stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop)]),
+        **generation_kwargs))
+
+    def end_on_failure(future: asyncio.Future) -> None:
+        # A failed generation never ends the streamer on its own
+        if future.cancelled() or future.exception() is not None:
+            streamer.end()
+
+    generation.add_done_callback(end_on_failure)
+
+    async def chunks() -> AsyncIterator[str]:
+        # Each read blocks until the next chunk, so wait off the loop
+        while (chunk := await asyncio.to_thread(next, streamer, None)) is not None:
+            if chunk:
+                yield chunk
+
+    return chunks(), generation, stop.set
 
-    full_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
 
-    # Only strip by "Answer:" when we used the default QA wrapper
-    if wrap_prompt and "Answer:" in full_text:
-        full_text = full_text.split("Answer:", 1)[1]
-    elif strip_after and strip_after in full_text:
-        full_text = full_text.split(strip_after, 1)[1]
+cache_prefix(QA_SYSTEM_INSTRUCTION)
 
-    return full_text.strip()
+if TORCH_COMPILE:
+    # Trigger compilation and CUDA graph capture now rather than on the first
+    # user request.
+    print("[llm_model] Warming up compiled model")
+    generate_text("Hello", max_new_tokens=80)
@@ -1,23 +1,101 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
 from typing import List, Literal, Optional
-from uuid import uuid4
-import hashlib
+import base64
+import functools
+import heapq
+import hmac
+import itertools
 import secrets
 import os
+import time
 
-from fastapi import FastAPI, HTTPException, Request, Depends, Header
+import anyio
+import bcrypt
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-
-from backend.llm_model import generate_text
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive, Scope, Send
+
+from backend.conversation_store import (
+    ConversationStore,
+    InMemoryConversationStore,
+    RedisConversationStore,
+    fast_token_urlsafe,
+    fast_uuid4,
+)
 
 # Enable mock auth bypass in development/testing
 MOCK_AUTH_ENABLED = os.getenv("MOCK_AUTH_ENABLED", "true").lower() == "true"
 
+# Serve generations from a vLLM sidecar instead of the in-process model.
+# The local model is then never imported, so it is not loaded either.
+USE_VLLM = bool(os.getenv("VLLM_URL"))
+
+if USE_VLLM:
+    from backend import vllm_client
+    from backend.vllm_client import count_tokens
+else:
+    from backend.llm_model import (
+        cache_fits,
+        cache_prefix,
+        count_tokens,
+        enqueue,
+        stream_text,
+    )
+
+# Share conversations between workers through Redis when a URL is given;
+# otherwise they live in this process only.
+CHAT_REDIS_URL = os.getenv("CHAT_REDIS_URL")
 
-app = FastAPI(title="Opportunity Center Chat Backend", version="1.0.0")
+# In-process only: past this many conversations (all users together) the
+# least recently used one is evicted. Redis bounds itself via maxmemory.
+CHAT_CONV_CAP = int(os.getenv("CHAT_CONV_CAP", "10000"))
+
+# Conversations whose KV cache is kept for the next turn. Each one holds the
+# model's keys/values for the whole transcript, so this bounds (GPU) memory.
+CHAT_KV_CACHE_CAP = int(os.getenv("CHAT_KV_CACHE_CAP", "32"))
+
+# Token budget for the history replayed into a fresh prompt. Older messages
+# are dropped first; the latest user message is always kept.
+MAX_HISTORY_TOKENS = int(os.getenv("CHAT_MAX_HISTORY_TOKENS", "1024"))
+
+# Messages per conversation kept as prompt lines (in a bounded deque, so
+# older ones are dropped as new ones arrive). The token budget above still
+# decides how many of them reach the prompt.
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "10"))
+
+CHAT_SYSTEM_PROMPT = (
+    "You are a helpful assistant for the Opportunity Center. "
+    "Provide a single concise answer to the most recent user question. "
+    "Do not invent or ask questions. Reply with only the answer text, no prefixes or labels. "
+    "Keep replies under 80 words."
+)
+
+# Every fresh prompt starts with this; built once, and also the prefix whose
+# KV state is prefilled at startup, so the two can never drift apart
+_PROMPT_PREFIX = f"{CHAT_SYSTEM_PROMPT}\n\nRecent conversation:\n"
+
+CHAT_GENERATION_KWARGS = {
+    "max_new_tokens": 80,
+    "temperature": 0.2,
+    "top_p": 0.8,
+    "do_sample": False,
+}
+
+
+# orjson serializes the message/summary lists in C, well ahead of stdlib json
+app = FastAPI(
+    title="Opportunity Center Chat Backend",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 # Configure CORS
 app.add_middleware(
@@ -28,7 +106,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class ChatMessage(BaseModel):
+
+class _GZipExceptStreams(GZipMiddleware):
+    # Gzip buffers output until it has a block worth flushing, which would
+    # hold SSE tokens back; streamed endpoints are passed through as-is
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# Conversation histories and lists are repetitive text; small bodies are
+# not worth the CPU
+app.add_middleware(_GZipExceptStreams, minimum_size=1024, compresslevel=5)
+
+
+class _Model(BaseModel):
+    # Write-once: nothing mutates these after validation, and unknown fields
+    # are rejected instead of being silently dropped. Pydantic v2 has no
+    # slots=True for BaseModel, so instances keep their __dict__.
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+
+class ChatMessage(_Model):
     id: str
     content: str
     role: Literal["user", "assistant"]
@@ -36,17 +137,17 @@ class ChatMessage(BaseModel):
     conversationId: str
 
 
-class SendMessageRequest(BaseModel):
+class SendMessageRequest(_Model):
     message: str
     conversationId: Optional[str] = None
 
 
-class SendMessageResponse(BaseModel):
+class SendMessageResponse(_Model):
     message: ChatMessage
     conversationId: str
 
 
-class ConversationSummary(BaseModel):
+class ConversationSummary(_Model):
     id: str
     title: str
     createdAt: str
@@ -54,7 +155,7 @@ class ConversationSummary(BaseModel):
     messageCount: int
 
 
-class ApiKeyRequest(BaseModel):
+class ApiKeyRequest(_Model):
     name: str
     title: str
     createdAt: str
@@ -62,23 +163,23 @@ class ApiKeyRequest(BaseModel):
     messageCount: int
 
 
-class ChatHistoryResponse(BaseModel):
+class ChatHistoryResponse(_Model):
     messages: List[ChatMessage]
     conversationId: str
 
 
-class LoginRequest(BaseModel):
+class LoginRequest(_Model):
     email: str
     password: str
 
 
-class RegisterRequest(BaseModel):
+class RegisterRequest(_Model):
     email: str
     password: str
     name: str
 
 
-class UserResponse(BaseModel):
+class UserResponse(_Model):
     id: str
     email: str
     name: str
@@ -86,63 +187,103 @@ class UserResponse(BaseModel):
     createdAt: str
 
 
-class AuthResponse(BaseModel):
+class AuthResponse(_Model):
     token: str
     user: UserResponse
 
 
 # --- Data ---
 
-conversation_messages: dict[str, dict[str, list[ChatMessage]]] = {}
-conversation_metadata: dict[str, dict[str, dict[str, datetime | str]]] = {}
+# Messages are kept as plain dicts shaped like ChatMessage; Pydantic only
+# sees them at the response boundary.
+store: ConversationStore = (
+    RedisConversationStore(CHAT_REDIS_URL, history_window=HISTORY_LIMIT)
+    if CHAT_REDIS_URL
+    else InMemoryConversationStore(history_window=HISTORY_LIMIT, max_conversations=CHAT_CONV_CAP)
+)
+# Per-conversation KV cache so follow-up turns only prefill the new message.
+# Entries are (message_count covered, cache); the tensors stay in this worker.
+# Keyed by (user_id, conversation_id), least recently used first.
+conversation_kv_cache: OrderedDict[tuple[str, str], tuple[int, dict]] = OrderedDict()
 
 # Session management
+# Session and reset-token times are time.time() floats: never sent to
+# clients, only compared, so no datetime objects or timedeltas per request
 sessions: dict[str, dict] = {}  # token -> {user_id, expires_at, created_at}
 SESSION_TIMEOUT_MINUTES = 60  # Configurable session timeout
 
-# Password storage (in production, use proper password hashing library like bcrypt)
-user_passwords: dict[str, str] = {}  # user_id -> hashed_password
+# Password storage
+user_passwords: dict[str, str] = {}  # user_id -> bcrypt hash
+# bcrypt work factor: 2**12 rounds, a few hundred ms per hash or check
+PASSWORD_HASH_ROUNDS = 12
 
 # Password reset tokens
 reset_tokens: dict[str, dict] = {}  # token -> {user_id, email, expires_at, created_at}
 RESET_TOKEN_TIMEOUT_MINUTES = 60  # Reset link valid for 1 hour
 
+# Min-heaps of (expires_at, token), so tokens nobody presents again are still
+# dropped once they expire. Entries may be stale (token already gone, or a
+# session extended since); _sweep_expired sorts that out when it reaches them.
+session_expiry: list[tuple[float, str]] = []
+reset_token_expiry: list[tuple[float, str]] = []
+
+# Timezone-aware UTC now (datetime.utcnow is naive and deprecated), bound
+# once to skip the attribute lookups on every request
+_utcnow = functools.partial(datetime.now, timezone.utc)
+
 
 def hash_password(password: str) -> str:
-    """Hash password using SHA-256 with salt"""
-    salt = secrets.token_hex(16)
-    pwd_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-    return f"{salt}${pwd_hash}"
+    """Hash password with bcrypt (salt included in the result)"""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=PASSWORD_HASH_ROUNDS)).decode()
 
 
 def verify_password(password: str, hashed: str) -> bool:
-    """Verify password against hash"""
+    """Verify password against hash; bcrypt compares in constant time"""
     try:
-        salt, pwd_hash = hashed.split('$')
-        return hashlib.sha256((password + salt).encode()).hexdigest() == pwd_hash
-    except:
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    except ValueError:
+        # Malformed stored hash, or a password that cannot be UTF-8 encoded
         return False
 
 
+def _sweep_expired(expiry: list[tuple[float, str]], entries: dict[str, dict], now: float) -> None:
+    """Drop every entry whose expiry has passed; amortized O(log n) per token."""
+    while expiry and now > expiry[0][0]:
+        _, token = heapq.heappop(expiry)
+        entry = entries.get(token)
+        if entry is None:
+            continue
+        if now > entry["expires_at"]:
+            del entries[token]
+        else:
+            # Extended since it was queued; requeue at its current expiry
+            heapq.heappush(expiry, (entry["expires_at"], token))
+
+
 def create_session(user_id: str) -> str:
     """Create a new session token"""
-    token = secrets.token_urlsafe(32)
+    token = fast_token_urlsafe()
+    now = time.time()
+    _sweep_expired(session_expiry, sessions, now)
+    expires_at = now + SESSION_TIMEOUT_MINUTES * 60
     sessions[token] = {
         "user_id": user_id,
-        "created_at": datetime.utcnow(),
-        "expires_at": datetime.utcnow() + timedelta(minutes=SESSION_TIMEOUT_MINUTES),
-        "last_activity": datetime.utcnow()
+        "created_at": now,
+        "expires_at": expires_at,
+        "last_activity": now
     }
+    heapq.heappush(session_expiry, (expires_at, token))
     return token
 
 
 def validate_session(token: str) -> Optional[str]:
     """Validate session and return user_id if valid"""
+    now = time.time()
+    _sweep_expired(session_expiry, sessions, now)
     if not token or token not in sessions:
         return None
     
     session = sessions[token]
-    now = datetime.utcnow()
     
     # Check if session expired
     if now > session["expires_at"]:
@@ -151,26 +292,30 @@ def validate_session(token: str) -> Optional[str]:
     
     # Update last activity and extend expiration
     session["last_activity"] = now
-    session["expires_at"] = now + timedelta(minutes=SESSION_TIMEOUT_MINUTES)
+    session["expires_at"] = now + SESSION_TIMEOUT_MINUTES * 60
     
     return session["user_id"]
 
 
-def require_auth(authorization: Optional[str] = Header(None)) -> str:
-    """Dependency to require authentication"""
-    if not authorization or not authorization.startswith("Bearer "):
-        # Allow mock bypass when enabled (dev/test only)
-        if MOCK_AUTH_ENABLED:
-            return "test-user"
-        raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
+# Mock token shortcut (only honoured with MOCK_AUTH_ENABLED)
+_MOCK_AUTHORIZATION = "Bearer mock-test-token"
 
-    token = authorization.replace("Bearer ", "")
 
-    # Mock token shortcut
-    if MOCK_AUTH_ENABLED and token == "mock-test-token":
+async def require_auth(authorization: Optional[str] = Header(None)) -> str:
+    """Dependency to require authentication"""
+    # Mock bypass (dev/test only), checked before any header parsing: no
+    # header, the mock token, or anything that is not a Bearer token
+    if MOCK_AUTH_ENABLED and (
+        not authorization
+        or authorization == _MOCK_AUTHORIZATION
+        or not authorization.startswith("Bearer ")
+    ):
         return "test-user"
 
-    user_id = validate_session(token)
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
+
+    user_id = validate_session(authorization[7:])
 
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
@@ -178,21 +323,21 @@ def require_auth(authorization: Optional[str] = Header(None)) -> str:
     return user_id
 
 
+# Role hierarchy: super-admin > admin > user
+_ROLE_LEVEL = {"super-admin": 3, "admin": 2, "user": 1}
+
+
 def require_role(required_role: str):
     """Dependency factory to require specific role"""
-    def role_checker(user_id: str = Depends(require_auth)) -> str:
-        user = next((u for u in users_db if u["id"] == user_id), None)
+    # Resolved once per decorated endpoint, not per request
+    required_level = _ROLE_LEVEL.get(required_role, 0)
+
+    async def role_checker(user_id: str = Depends(require_auth)) -> str:
+        user = users_by_id.get(user_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        user_role = user["role"]
-        
-        # Role hierarchy: super-admin > admin > user
-        role_hierarchy = {"super-admin": 3, "admin": 2, "user": 1}
-        required_level = role_hierarchy.get(required_role, 0)
-        user_level = role_hierarchy.get(user_role, 0)
-        
-        if user_level < required_level:
+        if _ROLE_LEVEL.get(user["role"], 0) < required_level:
             raise HTTPException(status_code=403, detail="Insufficient permissions")
         
         return user_id
@@ -206,129 +351,53 @@ def _get_user_id(request: Request) -> str:
     return user_id
 
 
-def _get_user_message_store(user_id: str) -> dict[str, list[ChatMessage]]:
-    return conversation_messages.setdefault(user_id, {})
-
-
-def _get_user_metadata_store(user_id: str) -> dict[str, dict[str, datetime | str]]:
-    return conversation_metadata.setdefault(user_id, {})
-
-
-def _derive_title(text: str) -> str:
-    cleaned = text.strip()
-    if not cleaned:
-        return "New Conversation"
-    return cleaned[:60] + ("..." if len(cleaned) > 60 else "")
-
-
-def _create_conversation(user_id: str, first_user_message: str) -> str:
-    user_meta = _get_user_metadata_store(user_id)
-    user_messages = _get_user_message_store(user_id)
-    conv_id = str(uuid4())
-    now = datetime.utcnow()
-    user_meta[conv_id] = {
-        "title": _derive_title(first_user_message),
-        "created_at": now,
-        "updated_at": now,
-    }
-    user_messages[conv_id] = []
-    return conv_id
-
-
-def _ensure_conversation(
-    user_id: str, conversation_id: Optional[str], user_message: str
-) -> str:
-    user_meta = _get_user_metadata_store(user_id)
-    if conversation_id and conversation_id in user_meta:
-        return conversation_id
-    return _create_conversation(user_id, user_message)
-
-
-def _store_message(
+async def _store_message(
     user_id: str, conversation_id: str, role: Literal["user", "assistant"], content: str
-) -> ChatMessage:
-    user_messages = _get_user_message_store(user_id)
-    user_meta = _get_user_metadata_store(user_id)
-
-    if conversation_id not in user_messages:
-        raise HTTPException(status_code=404, detail="Conversation not found.")
-
-    message = ChatMessage(
-        id=str(uuid4()),
-        content=content,
-        role=role,
-        timestamp=datetime.utcnow().isoformat(),
-        conversationId=conversation_id,
-    )
-    user_messages[conversation_id].append(message)
-
-    meta = user_meta[conversation_id]
-    meta["updated_at"] = datetime.utcnow()
-    if role == "user" and (not meta.get("title") or meta["title"] == "New Conversation"):
-        meta["title"] = _derive_title(content)
-
-    return message
-
-
-def _build_prompt(user_id: str, conversation_id: str) -> str:
-    history = _get_user_message_store(user_id).get(conversation_id, [])
-    recent_history = history[-10:]
-
-    latest_user = next(
-        (msg for msg in reversed(recent_history) if msg.role == "user"), None
+) -> tuple[dict, int]:
+    """Append a message; returns it with the conversation's new message count."""
+    # Tokenized once here so prompt building never re-tokenizes history
+    stored = await store.append_message(
+        user_id, conversation_id, role, content, count_tokens(content)
     )
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+    return stored
 
-    history_lines = []
-    for msg in recent_history:
-        role = "User" if msg.role == "user" else "Assistant"
-        history_lines.append(f"{role}: {msg.content}")
-    history_block = "\n".join(history_lines)
 
-    if not latest_user:
-        latest_content = ""
-    else:
-        latest_content = latest_user.content
+async def _build_prompt(user_id: str, conversation_id: str) -> str:
+    # The store keeps the last HISTORY_LIMIT messages already formatted as
+    # prompt lines
+    history = await store.history_lines(user_id, conversation_id)
 
-    system = (
-        "You are a helpful assistant for the Opportunity Center. "
-        "Provide a single concise answer to the most recent user question. "
-        "Do not invent or ask questions. Reply with only the answer text, no prefixes or labels. "
-        "Keep replies under 80 words."
-    )
+    # Walk them newest first until the token budget runs out, then join the
+    # kept tail in place; no intermediate list of lines
+    start = len(history)
+    budget = MAX_HISTORY_TOKENS
+    while start and (start == len(history) or history[start - 1][1] <= budget):
+        start -= 1
+        budget -= history[start][1]
+    history_block = "\n".join(line for line, _ in itertools.islice(history, start, None))
 
-    return (
-        f"{system}\n\n"
-        f"Recent conversation:\n{history_block}\n\n"
-        f"Answer the latest user question once. Do not add new questions.\n"
-        f"Latest question: {latest_content}\n"
-        f"Answer:"
-    )
+    # Plain transcript ending in "Assistant:" so later turns can be appended
+    # to the cached KV state without re-prefilling this prefix.
+    return f"{_PROMPT_PREFIX}{history_block}\nAssistant:"
 
 
-def _conversation_summary(user_id: str, conversation_id: str) -> ConversationSummary:
-    user_meta = _get_user_metadata_store(user_id)
-    user_messages = _get_user_message_store(user_id)
+if not USE_VLLM:
+    # Every cold chat prompt starts with this, so prefill it once at startup
+    cache_prefix(_PROMPT_PREFIX)
 
-    if conversation_id not in user_meta:
-        raise HTTPException(status_code=404, detail="Conversation not found.")
 
-    meta = user_meta[conversation_id]
-    messages = user_messages.get(conversation_id, [])
-
-    title = meta.get("title", "New Conversation")
-    if (not title or title == "New Conversation") and messages:
-        for msg in messages:
-            if msg.role == "user":
-                title = _derive_title(msg.content)
-                break
-
-    return ConversationSummary(
-        id=conversation_id,
-        title=title or "Conversation",
-        createdAt=meta["created_at"].isoformat(),
-        updatedAt=meta["updated_at"].isoformat(),
-        messageCount=len(messages),
-    )
+def _conversation_summary(meta: dict) -> dict:
+    # The store keeps the title derived from the first user message.
+    # Shaped like ConversationSummary; all fields are server-generated.
+    return {
+        "id": meta["id"],
+        "title": meta.get("title") or "Conversation",
+        "createdAt": meta["created_at"],
+        "updatedAt": meta["updated_at"],
+        "messageCount": meta["message_count"],
+    }
 
 # --- Endpoints ---
 
@@ -339,15 +408,30 @@ async def root():
 
 # --- Auth Endpoints ---
 
-@app.post("/api/auth/register", response_model=AuthResponse)
-def register(req: RegisterRequest):
+# The auth endpoints build their bodies from server-side user records, so
+# they return ORJSONResponse and document the schema via `responses`: no
+# models to construct, nothing for FastAPI to validate again on the way out.
+
+def _user_response(user: dict) -> dict:
+    # Shaped like UserResponse; only the public fields
+    return {
+        "id": user["id"],
+        "email": user["email"],
+        "name": user["name"],
+        "role": user["role"],
+        "createdAt": user["createdAt"],
+    }
+
+
+@app.post("/api/auth/register", responses={200: {"model": AuthResponse}})
+async def register(req: RegisterRequest):
     # Check if user already exists
-    existing_user = next((u for u in users_db if u["email"] == req.email), None)
+    existing_user = users_by_email.get(req.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # Hash password
-    hashed_pwd = hash_password(req.password)
+    # Hash password (bcrypt is slow by design; keep it off the event loop)
+    hashed_pwd = await run_in_threadpool(hash_password, req.password)
     
     # Create new user
     new_user = {
@@ -355,101 +439,103 @@ def register(req: RegisterRequest):
         "email": req.email,
         "name": req.name,
         "role": "user",
-        "createdAt": datetime.utcnow().isoformat() + "Z"
+        "createdAt": _utcnow().isoformat().replace("+00:00", "Z")
     }
-    users_db.append(new_user)
+    _add_user(new_user)
     user_passwords[new_user["id"]] = hashed_pwd
     
     # Create session
     token = create_session(new_user["id"])
     
-    return AuthResponse(
-        token=token,
-        user=UserResponse(**new_user)
-    )
+    return ORJSONResponse({"token": token, "user": _user_response(new_user)})
 
 
-@app.post("/api/auth/login", response_model=AuthResponse)
-def login(req: LoginRequest):
+@app.post("/api/auth/login", responses={200: {"model": AuthResponse}})
+async def login(req: LoginRequest):
     # Find user by email
-    user = next((u for u in users_db if u["email"] == req.email), None)
+    user = users_by_email.get(req.email)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     # Verify password
     stored_password = user_passwords.get(user["id"])
-    if not stored_password or not verify_password(req.password, stored_password):
+    if not stored_password or not await run_in_threadpool(
+        verify_password, req.password, stored_password
+    ):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     # Create session
     token = create_session(user["id"])
     
-    return AuthResponse(
-        token=token,
-        user=UserResponse(**user)
-    )
+    return ORJSONResponse({"token": token, "user": _user_response(user)})
 
 
 @app.post("/api/auth/logout")
-def logout(authorization: Optional[str] = Header(None)):
-    if authorization and authorization.startswith("Bearer "):
-        token = authorization.replace("Bearer ", "")
+async def logout(authorization: Optional[str] = Header(None)):
+    # The mock token never has a session to drop
+    if (
+        authorization
+        and authorization != _MOCK_AUTHORIZATION
+        and authorization.startswith("Bearer ")
+    ):
+        token = authorization[7:]
         if token in sessions:
             del sessions[token]
     return {"message": "Logged out successfully"}
 
 
-@app.get("/api/auth/me", response_model=UserResponse)
-def get_current_user(user_id: str = Depends(require_auth)):
-    user = next((u for u in users_db if u["id"] == user_id), None)
+@app.get("/api/auth/me", responses={200: {"model": UserResponse}})
+async def get_current_user(user_id: str = Depends(require_auth)):
+    user = users_by_id.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return UserResponse(**user)
+    return ORJSONResponse(_user_response(user))
 
 
-@app.post("/api/auth/refresh", response_model=AuthResponse)
-def refresh_token(user_id: str = Depends(require_auth)):
-    user = next((u for u in users_db if u["id"] == user_id), None)
+@app.post("/api/auth/refresh", responses={200: {"model": AuthResponse}})
+async def refresh_token(user_id: str = Depends(require_auth)):
+    user = users_by_id.get(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid token")
     
     # Create new session
     token = create_session(user["id"])
-    return AuthResponse(
-        token=token,
-        user=UserResponse(**user)
-    )
+    return ORJSONResponse({"token": token, "user": _user_response(user)})
 
 
-class PasswordResetRequest(BaseModel):
+class PasswordResetRequest(_Model):
     email: str
 
 
-class PasswordResetSubmit(BaseModel):
+class PasswordResetSubmit(_Model):
     token: str
     new_password: str
 
 
-class UsernameRecoveryRequest(BaseModel):
+class UsernameRecoveryRequest(_Model):
     email: str
 
 
 @app.post("/api/auth/reset-password-request")
-def request_password_reset(request: PasswordResetRequest):
+async def request_password_reset(request: PasswordResetRequest):
     """Request a password reset link"""
-    user = next((u for u in users_db if u["email"] == request.email), None)
+    user = users_by_email.get(request.email)
     
     # Always return success to prevent email enumeration
     # In production, send actual email here
     if user:
         # Generate reset token
-        token = secrets.token_urlsafe(32)
+        token = fast_token_urlsafe()
+        now = time.time()
+        _sweep_expired(reset_token_expiry, reset_tokens, now)
+        expires_at = now + RESET_TOKEN_TIMEOUT_MINUTES * 60
         reset_tokens[token] = {
             "user_id": user["id"],
             "email": user["email"],
-            "created_at": datetime.utcnow(),
-            "expires_at": datetime.utcnow() + timedelta(minutes=RESET_TOKEN_TIMEOUT_MINUTES)
+            "created_at": now,
+            "expires_at": expires_at
         }
+        heapq.heappush(reset_token_expiry, (expires_at, token))
         
         # In production, send email with link: http://localhost:3000/recovery/reset-password/{token}
         print(f"Password reset link for {request.email}: http://localhost:3000/recovery/reset-password/{token}")
@@ -461,13 +547,13 @@ def request_password_reset(request: PasswordResetRequest):
 
 
 @app.get("/api/auth/validate-reset-token")
-def validate_reset_token(token: str):
+async def validate_reset_token(token: str):
     """Validate a password reset token"""
     if token not in reset_tokens:
         raise HTTPException(status_code=400, detail="Invalid reset token")
     
     token_data = reset_tokens[token]
-    now = datetime.utcnow()
+    now = time.time()
     
     if now > token_data["expires_at"]:
         del reset_tokens[token]
@@ -477,13 +563,13 @@ def validate_reset_token(token: str):
 
 
 @app.post("/api/auth/reset-password")
-def reset_password(request: PasswordResetSubmit):
+async def reset_password(request: PasswordResetSubmit):
     """Reset password using valid token"""
     if request.token not in reset_tokens:
         raise HTTPException(status_code=400, detail="Invalid reset token")
     
     token_data = reset_tokens[request.token]
-    now = datetime.utcnow()
+    now = time.time()
     
     if now > token_data["expires_at"]:
         del reset_tokens[request.token]
@@ -491,7 +577,7 @@ def reset_password(request: PasswordResetSubmit):
     
     # Update password
     user_id = token_data["user_id"]
-    user_passwords[user_id] = hash_password(request.new_password)
+    user_passwords[user_id] = await run_in_threadpool(hash_password, request.new_password)
     
     # Invalidate token
     del reset_tokens[request.token]
@@ -508,9 +594,9 @@ def reset_password(request: PasswordResetSubmit):
 
 
 @app.post("/api/auth/recover-username")
-def recover_username(request: UsernameRecoveryRequest):
+async def recover_username(request: UsernameRecoveryRequest):
     """Recover username by email"""
-    user = next((u for u in users_db if u["email"] == request.email), None)
+    user = users_by_email.get(request.email)
     
     if not user:
         raise HTTPException(status_code=404, detail="No account found with this email address")
@@ -525,55 +611,77 @@ def recover_username(request: UsernameRecoveryRequest):
     }
 
 
-@app.get("/api/chat/conversations", response_model=List[ConversationSummary])
-def list_conversations(request: Request):
+# Summaries are plain dicts returned in an ORJSONResponse, so FastAPI neither
+# validates them nor walks them with jsonable_encoder; `responses` documents
+# the schema.
+@app.get(
+    "/api/chat/conversations",
+    responses={200: {"model": List[ConversationSummary]}},
+)
+async def list_conversations(request: Request, limit: Optional[int] = Query(None, ge=1)):
     user_id = _get_user_id(request)
-    user_meta = _get_user_metadata_store(user_id)
 
-    summaries = [_conversation_summary(user_id, conv_id) for conv_id in user_meta]
-    summaries.sort(key=lambda s: s.updatedAt, reverse=True)
-    return summaries
+    # The store keeps conversations in recency order, so reading the newest
+    # `limit` never touches (or sorts) the rest
+    return ORJSONResponse([
+        _conversation_summary(meta)
+        for meta in await store.list_conversations(user_id, limit)
+    ])
 
 
-@app.get("/api/chat/conversations/{conversation_id}", response_model=ChatHistoryResponse)
-def get_conversation(conversation_id: str, request: Request):
+# Documented via `responses` rather than response_model: the body is spliced
+# together from each message's JSON, encoded once when it was stored.
+@app.get(
+    "/api/chat/conversations/{conversation_id}",
+    responses={200: {"model": ChatHistoryResponse}},
+)
+async def get_conversation(conversation_id: str, request: Request):
     user_id = _get_user_id(request)
-    user_messages = _get_user_message_store(user_id)
+    messages_json = await store.get_messages_json(user_id, conversation_id)
 
-    if conversation_id not in user_messages:
+    if messages_json is None:
         raise HTTPException(status_code=404, detail="Conversation not found.")
 
-    return ChatHistoryResponse(
-        messages=user_messages[conversation_id],
-        conversationId=conversation_id,
-    )
+    body = b"".join((
+        b'{"messages":[',
+        b",".join(messages_json),
+        b'],"conversationId":',
+        orjson.dumps(conversation_id),
+        b"}",
+    ))
+    return Response(content=body, media_type="application/json")
 
 
 # --- API Key Management ---
 
-api_keys_db = {}  # key_id -> {id, name, key_hash, createdAt, lastUsed}
+api_keys_db = {}  # key_id -> {id, name, key_hash, masked, createdAt, lastUsed}
 api_key_usage_logs = []  # List of {keyId, action, timestamp}
 
 
+# Server-side secret mixed into every API key hash. Keys are random 256-bit
+# tokens, so one keyed HMAC-SHA256 is enough (no per-key salt or slow KDF).
+# Without API_KEY_PEPPER a per-process pepper is used, matching keys that
+# live only in this process's memory.
+API_KEY_PEPPER = os.environ.get("API_KEY_PEPPER", "").encode() or secrets.token_bytes(32)
+
+
 def hash_api_key(key: str) -> str:
-    """Hash API key using SHA-256 with salt"""
-    salt = secrets.token_hex(16)
-    key_hash = hashlib.sha256((key + salt).encode()).hexdigest()
-    return f"{salt}${key_hash}"
+    """Hash API key with HMAC-SHA256 under the server pepper (base64)"""
+    return base64.b64encode(hmac.digest(API_KEY_PEPPER, key.encode(), "sha256")).decode()
 
 
 def verify_api_key(key: str, hashed: str) -> bool:
     """Verify API key against hash"""
     try:
-        salt, key_hash = hashed.split('$')
-        return hashlib.sha256((key + salt).encode()).hexdigest() == key_hash
-    except:
+        return hmac.compare_digest(hash_api_key(key), hashed)
+    except ValueError:
+        # A key that cannot be UTF-8 encoded (lone surrogates)
         return False
 
 
 def generate_api_key() -> str:
     """Generate a cryptographically secure API key"""
-    return "sk_" + secrets.token_urlsafe(32)
+    return "sk_" + fast_token_urlsafe()
 
 
 def mask_api_key(key: str) -> str:
@@ -613,43 +721,69 @@ users_db = [
     }
 ]
 
-# Initialize default passwords (password: "admin123" for all)
+# Indexes over users_db (which keeps creation order for listing). Always
+# change users through the helpers below so they stay in step.
+users_by_id: dict[str, dict] = {u["id"]: u for u in users_db}
+users_by_email: dict[str, dict] = {u["email"]: u for u in users_db}
+role_counts: Counter[str] = Counter(u["role"] for u in users_db)
+
+
+def _add_user(user: dict) -> None:
+    users_db.append(user)
+    users_by_id[user["id"]] = user
+    users_by_email[user["email"]] = user
+    role_counts[user["role"]] += 1
+
+
+def _remove_user(user: dict) -> None:
+    users_db.remove(user)
+    del users_by_id[user["id"]]
+    users_by_email.pop(user["email"], None)
+    role_counts[user["role"]] -= 1
+
+
+def _set_user_field(user: dict, key: str, value) -> None:
+    if key == "email":
+        users_by_email.pop(user["email"], None)
+        users_by_email[value] = user
+    elif key == "role":
+        role_counts[user["role"]] -= 1
+        role_counts[value] += 1
+    user[key] = value
+
+# Initialize default passwords (password: "admin123" for all). Hashed once:
+# each bcrypt hash costs a few hundred ms of startup, and sharing one salted
+# hash is fine for seed accounts that all have the same known password.
+_DEFAULT_PASSWORD_HASH = hash_password("admin123")
 for user in users_db:
-    user_passwords[user["id"]] = hash_password("admin123")
+    user_passwords[user["id"]] = _DEFAULT_PASSWORD_HASH
 
 @app.get("/api/admin/stats")
-def get_admin_stats(user_id: str = Depends(require_role("admin"))):
-    # Calculate actual stats from stored data
-    total_users = len(users_db)
-    total_conversations = sum(len(convs) for convs in conversation_messages.values())
-    total_messages = sum(
-        len(messages) 
-        for user_convs in conversation_messages.values() 
-        for messages in user_convs.values()
-    )
-    # Count users with at least one conversation
-    active_users = sum(1 for user_convs in conversation_messages.values() if user_convs)
-    
-    return {
-        "totalUsers": total_users,
-        "totalConversations": total_conversations,
-        "totalMessages": total_messages,
-        "activeUsers": active_users,
-    }
+async def get_admin_stats(user_id: str = Depends(require_role("admin"))):
+    # The store keeps running totals, so this is a counter lookup
+    totals = await store.stats()
+
+    return ORJSONResponse({
+        "totalUsers": len(users_db),
+        "totalConversations": totals["total_conversations"],
+        "totalMessages": totals["total_messages"],
+        # Users with at least one conversation
+        "activeUsers": totals["active_users"],
+    })
 
 @app.get("/api/admin/users")
-def get_admin_users(user_id: str = Depends(require_role("admin"))):
-    return users_db
+async def get_admin_users(user_id: str = Depends(require_role("admin"))):
+    return ORJSONResponse(users_db)
 
 @app.post("/api/admin/users")
-def create_admin_user(data: dict, user_id: str = Depends(require_role("admin"))):
+async def create_admin_user(data: dict, user_id: str = Depends(require_role("admin"))):
     # Check if user already exists
-    existing_user = next((u for u in users_db if u["email"] == data.get("email")), None)
+    existing_user = users_by_email.get(data.get("email"))
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already exists")
     
     # Only super-admin can create admin or super-admin users
-    requesting_user = next((u for u in users_db if u["id"] == user_id), None)
+    requesting_user = users_by_id.get(user_id)
     new_role = data.get("role", "user")
     
     if new_role in ["admin", "super-admin"] and requesting_user["role"] != "super-admin":
@@ -657,7 +791,7 @@ def create_admin_user(data: dict, user_id: str = Depends(require_role("admin")))
     
     # Hash password
     password = data.get("password", "password123")
-    hashed_pwd = hash_password(password)
+    hashed_pwd = await run_in_threadpool(hash_password, password)
     
     # Create new user
     new_user = {
@@ -665,14 +799,14 @@ def create_admin_user(data: dict, user_id: str = Depends(require_role("admin")))
         "name": data.get("name"),
         "email": data.get("email"),
         "role": new_role,
-        "createdAt": datetime.utcnow().isoformat() + "Z"
+        "createdAt": _utcnow().isoformat().replace("+00:00", "Z")
     }
-    users_db.append(new_user)
+    _add_user(new_user)
     user_passwords[new_user["id"]] = hashed_pwd
     return new_user
 
 @app.get("/api/admin/settings")
-def get_admin_settings(user_id: str = Depends(require_role("admin"))):
+async def get_admin_settings(user_id: str = Depends(require_role("admin"))):
     return {
         **system_settings,
         "sessionTimeoutMinutes": SESSION_TIMEOUT_MINUTES
@@ -680,11 +814,11 @@ def get_admin_settings(user_id: str = Depends(require_role("admin"))):
 
 
 @app.get("/api/admin/models")
-def get_available_models(user_id: str = Depends(require_role("admin"))):
+async def get_available_models(user_id: str = Depends(require_role("admin"))):
     return {"models": available_models}
 
 @app.put("/api/admin/settings")
-def update_admin_settings(settings: dict, user_id: str = Depends(require_role("super-admin"))):
+async def update_admin_settings(settings: dict, user_id: str = Depends(require_role("super-admin"))):
     # Only super-admin can update settings
     global SESSION_TIMEOUT_MINUTES
     
@@ -703,21 +837,21 @@ def update_admin_settings(settings: dict, user_id: str = Depends(require_role("s
     }
 
 @app.get("/api/admin/users/{user_id}")
-def get_admin_user(user_id: str, admin_user_id: str = Depends(require_role("admin"))):
-    user = next((u for u in users_db if u["id"] == user_id), None)
+async def get_admin_user(user_id: str, admin_user_id: str = Depends(require_role("admin"))):
+    user = users_by_id.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 @app.put("/api/admin/users/{user_id}")
-def update_admin_user(user_id: str, data: dict, admin_user_id: str = Depends(require_role("admin"))):
-    user = next((u for u in users_db if u["id"] == user_id), None)
+async def update_admin_user(user_id: str, data: dict, admin_user_id: str = Depends(require_role("admin"))):
+    user = users_by_id.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Check role change permissions
     if "role" in data:
-        requesting_user = next((u for u in users_db if u["id"] == admin_user_id), None)
+        requesting_user = users_by_id.get(admin_user_id)
         new_role = data["role"]
         
         # Only super-admin can change roles to admin or super-admin
@@ -726,20 +860,24 @@ def update_admin_user(user_id: str, data: dict, admin_user_id: str = Depends(req
         
         # Cannot demote the last super-admin
         if user["role"] == "super-admin" and new_role != "super-admin":
-            super_admin_count = sum(1 for u in users_db if u["role"] == "super-admin")
-            if super_admin_count <= 1:
+            if role_counts["super-admin"] <= 1:
                 raise HTTPException(status_code=400, detail="Cannot demote the last super-admin")
     
+    # Emails are unique once indexed
+    if "email" in data:
+        owner = users_by_email.get(data["email"])
+        if owner is not None and owner is not user:
+            raise HTTPException(status_code=400, detail="Email already exists")
+
     # Update user fields
     for key, value in data.items():
         if key in user and key != "id":
-            user[key] = value
+            _set_user_field(user, key, value)
     return user
 
 @app.delete("/api/admin/users/{user_id}")
-def delete_admin_user(user_id: str, admin_user_id: str = Depends(require_role("admin"))):
-    global users_db
-    user = next((u for u in users_db if u["id"] == user_id), None)
+async def delete_admin_user(user_id: str, admin_user_id: str = Depends(require_role("admin"))):
+    user = users_by_id.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -749,53 +887,55 @@ def delete_admin_user(user_id: str, admin_user_id: str = Depends(require_role("a
     
     # Cannot delete the last super-admin
     if user["role"] == "super-admin":
-        super_admin_count = sum(1 for u in users_db if u["role"] == "super-admin")
-        if super_admin_count <= 1:
+        if role_counts["super-admin"] <= 1:
             raise HTTPException(status_code=400, detail="Cannot delete the last super-admin")
     
     # Only super-admin can delete admin users
-    requesting_user = next((u for u in users_db if u["id"] == admin_user_id), None)
+    requesting_user = users_by_id.get(admin_user_id)
     if user["role"] in ["admin", "super-admin"] and requesting_user["role"] != "super-admin":
         raise HTTPException(status_code=403, detail="Only super-admin can delete admin users")
     
-    users_db = [u for u in users_db if u["id"] != user_id]
+    _remove_user(user)
     if user_id in user_passwords:
         del user_passwords[user_id]
     return {"message": "User deleted successfully"}
 
 
 @app.get("/api/admin/api-keys")
-def get_api_keys(user_id: str = Depends(require_role("admin"))):
+async def get_api_keys(user_id: str = Depends(require_role("admin"))):
     """Get all API keys (masked)"""
     keys = [
         {
             "id": key_data["id"],
             "name": key_data["name"],
-            "key": mask_api_key(key_data["key_hash"]),  # Masked
+            "key": key_data["masked"],  # Masked once, at creation
             "createdAt": key_data["createdAt"],
             "lastUsed": key_data.get("lastUsed"),
         }
         for key_data in api_keys_db.values()
     ]
-    return keys
+    return ORJSONResponse(keys)
 
 
 @app.post("/api/admin/api-keys")
-def create_api_key(
+async def create_api_key(
     request: ApiKeyRequest, user_id: str = Depends(require_role("super-admin"))
 ):
     """Create a new API key (only super-admin)"""
     # Generate a new key
     new_key = generate_api_key()
-    key_id = str(uuid4())
+    key_id = fast_uuid4()
     
     # Hash and store
     key_hash = hash_api_key(new_key)
+    masked = mask_api_key(key_hash)
+    now_iso = _utcnow().isoformat().replace("+00:00", "Z")
     api_keys_db[key_id] = {
         "id": key_id,
         "name": request.name or f"Key {len(api_keys_db) + 1}",
         "key_hash": key_hash,
-        "createdAt": datetime.utcnow().isoformat() + "Z",
+        "masked": masked,
+        "createdAt": now_iso,
         "lastUsed": None,
     }
     
@@ -803,14 +943,14 @@ def create_api_key(
     api_key_usage_logs.append({
         "keyId": key_id,
         "action": "created",
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": now_iso,
     })
     
     # Return full key only once (will not be retrievable later)
     return {
         "id": key_id,
         "name": api_keys_db[key_id]["name"],
-        "key": mask_api_key(key_hash),  # Masked for consistency
+        "key": masked,  # Masked for consistency
         "fullKey": new_key,  # Only shown here
         "createdAt": api_keys_db[key_id]["createdAt"],
         "lastUsed": None,
@@ -818,7 +958,7 @@ def create_api_key(
 
 
 @app.delete("/api/admin/api-keys/{key_id}")
-def revoke_api_key(
+async def revoke_api_key(
     key_id: str, user_id: str = Depends(require_role("super-admin"))
 ):
     """Revoke (delete) an API key"""
@@ -831,77 +971,231 @@ def revoke_api_key(
     api_key_usage_logs.append({
         "keyId": key_id,
         "action": "revoked",
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": _utcnow().isoformat().replace("+00:00", "Z"),
     })
     
     return {"message": "API key revoked successfully"}
 
+async def _start_chat_turn(
+    req: SendMessageRequest, request: Request
+) -> tuple[str, str, tuple[int, Optional[dict]], str, Optional[dict]]:
+    """Store the user message and build the prompt for the model.
 
-
-def chat_with_llm(req: SendMessageRequest, request: Request):
+    Returns (user_id, conversation_id, undo, prompt, kv_cache); ``undo`` is
+    what _abort_chat_turn needs to revert the turn.
+    """
     user_id = _get_user_id(request)
     message_text = req.message.strip()
     if not message_text:
         raise HTTPException(status_code=400, detail="Message must not be empty.")
 
-    conversation_id = _ensure_conversation(user_id, req.conversationId, message_text)
+    # Add the user message to history before calling the model; one store
+    # call finds (or creates) the conversation and appends to it
+    started = await store.start_turn(
+        user_id, req.conversationId, message_text, count_tokens(message_text)
+    )
+    if started is None:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+    conversation_id, message_count, previous = started
+    undo = (message_count, previous)
+
+    if USE_VLLM:
+        # vLLM's prefix caching reuses the history prefix on its side
+        prompt = await _build_prompt(user_id, conversation_id)
+        return user_id, conversation_id, undo, prompt, None
+
+    # Popped so a failed generation never leaves a half-updated cache behind
+    cache = None
+    entry = conversation_kv_cache.pop((user_id, conversation_id), None)
+    if entry is not None:
+        covered, cache = entry
+        if covered != message_count - 1:
+            cache = None  # another worker added turns this cache has not seen
+        elif not cache_fits(
+            cache, count_tokens(message_text), CHAT_GENERATION_KWARGS["max_new_tokens"]
+        ):
+            cache = None  # too long to append to; re-prefill a budgeted window
+    if cache is None:
+        prompt = await _build_prompt(user_id, conversation_id)
+    else:
+        prompt = f"\nUser: {message_text}\nAssistant:"
+    return user_id, conversation_id, undo, prompt, cache
+
+
+async def _finish_chat_turn(
+    user_id: str, conversation_id: str, reply_text: str, cache: Optional[dict]
+) -> dict:
+    message, message_count = await _store_message(
+        user_id, conversation_id, "assistant", reply_text
+    )
+    if cache is not None:
+        conversation_kv_cache[(user_id, conversation_id)] = (message_count, cache)
+        if len(conversation_kv_cache) > CHAT_KV_CACHE_CAP:
+            conversation_kv_cache.popitem(last=False)
+    return message
 
-    # Add the user message to history before calling the model
-    _store_message(user_id, conversation_id, "user", message_text)
 
-    prompt = _build_prompt(user_id, conversation_id)
+async def _abort_chat_turn(
+    user_id: str, conversation_id: str, undo: tuple[int, Optional[dict]]
+) -> None:
+    """Undo a turn whose reply was never stored.
+
+    Drops the user message, so history never holds a question without an
+    answer, and any KV cache entry for the conversation. A conversation the
+    turn created is removed altogether.
+    """
+    # Shielded: after a client disconnect this runs in a cancelled scope
+    with anyio.CancelScope(shield=True):
+        conversation_kv_cache.pop((user_id, conversation_id), None)
+        await store.undo_turn(user_id, conversation_id, *undo)
+
+
+# The stored message dict is returned as-is, like in get_conversation
+@app.post("/api/chat/message", responses={200: {"model": SendMessageResponse}})
+async def chat_with_llm(req: SendMessageRequest, request: Request):
+    user_id, conversation_id, undo, prompt, cache = await _start_chat_turn(req, request)
 
     try:
-        reply_text = generate_text(
-            prompt=prompt,
-            max_new_tokens=80,
-            temperature=0.2,
-            top_p=0.8,
-            do_sample=False,
-            wrap_prompt=False,
-            strip_after="Answer:",
-        )
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception:
-        raise HTTPException(status_code=500, detail="LLM generation failed.")
-
-    assistant_message = _store_message(user_id, conversation_id, "assistant", reply_text)
-
-    return SendMessageResponse(
-        message=assistant_message,
-        conversationId=conversation_id,
+        try:
+            if USE_VLLM:
+                reply_text = await vllm_client.generate_text(
+                    prompt=prompt, **CHAT_GENERATION_KWARGS
+                )
+            else:
+                # Queued for the micro-batcher, which runs generate off the loop
+                reply_text, cache = await enqueue(
+                    prompt=prompt, cache=cache, **CHAT_GENERATION_KWARGS
+                )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception:
+            raise HTTPException(status_code=500, detail="LLM generation failed.")
+
+        assistant_message = await _finish_chat_turn(user_id, conversation_id, reply_text, cache)
+    except BaseException:
+        # Also on cancellation, e.g. the client hung up
+        await _abort_chat_turn(user_id, conversation_id, undo)
+        raise
+
+    # Returned as a response object so FastAPI skips its jsonable_encoder pass;
+    # orjson encodes the plain dicts directly.
+    return ORJSONResponse({
+        "message": assistant_message,
+        "conversationId": conversation_id,
+    })
+
+
+def _sse(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+def _sse_token(text: str) -> bytes:
+    # Same frame as _sse({"token": text}), without a dict per token
+    return b'data: {"token":' + orjson.dumps(text) + b"}\n\n"
+
+
+@app.post("/api/chat/message/stream")
+async def chat_with_llm_stream(req: SendMessageRequest, request: Request):
+    """Stream the reply as Server-Sent Events while it is generated.
+
+    Frames are ``{"token": ...}`` text chunks, then a final
+    ``{"message": ..., "conversationId": ...}`` once the reply is stored,
+    then ``{"done": true}``.
+    """
+    user_id, conversation_id, undo, prompt, cache = await _start_chat_turn(req, request)
+
+    async def event_stream():
+        stored = False
+        stop_generation = None
+        try:
+            try:
+                if USE_VLLM:
+                    parts = []
+                    async for chunk in vllm_client.stream_text(
+                        prompt=prompt, **CHAT_GENERATION_KWARGS
+                    ):
+                        if not parts:
+                            chunk = chunk.lstrip()
+                            if not chunk:
+                                continue
+                        parts.append(chunk)
+                        yield _sse_token(chunk)
+                    reply_text, new_cache = "".join(parts).strip(), None
+                else:
+                    chunks, generation, stop_generation = stream_text(
+                        prompt=prompt, cache=cache, **CHAT_GENERATION_KWARGS
+                    )
+                    async for chunk in chunks:
+                        yield _sse_token(chunk)
+                    reply_text, new_cache = await generation
+            except Exception:
+                yield _sse({"error": "LLM generation failed."})
+                return
+
+            try:
+                assistant_message = await _finish_chat_turn(
+                    user_id, conversation_id, reply_text, new_cache
+                )
+            except HTTPException as e:
+                # Deleted while streaming; headers are already sent, so report it in-band
+                yield _sse({"error": e.detail})
+                return
+            stored = True
+            yield _sse({"message": assistant_message, "conversationId": conversation_id})
+            yield _sse({"done": True})
+        finally:
+            # Generation failed, or the client disconnected mid-stream
+            if not stored:
+                if stop_generation is not None:
+                    # Otherwise it runs on to max_new_tokens, holding the
+                    # generation thread and the streamer reader
+                    stop_generation()
+                await _abort_chat_turn(user_id, conversation_id, undo)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Keep proxies (nginx in particular) from buffering or caching frames
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
 @app.delete("/api/chat/conversations/{conversation_id}")
-def delete_conversation(conversation_id: str, request: Request):
+async def delete_conversation(conversation_id: str, request: Request):
     user_id = _get_user_id(request)
-    user_meta = _get_user_metadata_store(user_id)
 
-    if conversation_id not in user_meta:
+    if not await store.delete_conversation(user_id, conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found.")
 
-    _get_user_message_store(user_id).pop(conversation_id, None)
-    user_meta.pop(conversation_id, None)
+    conversation_kv_cache.pop((user_id, conversation_id), None)
     return {"message": "Conversation deleted."}
 
 
 @app.delete("/api/chat/conversations/{conversation_id}/messages")
-def clear_conversation_messages(conversation_id: str, request: Request):
+async def clear_conversation_messages(conversation_id: str, request: Request):
     user_id = _get_user_id(request)
-    user_meta = _get_user_metadata_store(user_id)
-    user_messages = _get_user_message_store(user_id)
 
-    if conversation_id not in user_meta:
+    if not await store.clear_messages(user_id, conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found.")
 
-    user_messages[conversation_id] = []
-    user_meta[conversation_id]["updated_at"] = datetime.utcnow()
+    conversation_kv_cache.pop((user_id, conversation_id), None)
     return {"message": "Conversation messages cleared."}
 
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker loads its own model and keeps its own sessions and (without
+    # CHAT_REDIS_URL) conversations, so more than one needs a shared store and
+    # sticky sessions at the proxy. uvicorn only forks workers from an import
+    # string, not an app object.
+    # uvloop has no Windows build; httptools ships with uvicorn[standard]
+    uvicorn.run(
+        "backend.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WORKERS", "1")),
+        proxy_headers=True,
+        loop="asyncio" if os.name == "nt" else "uvloop",
+        http="httptools",
+    )
@@ -0,0 +1,235 @@
+# backend/tests/test_conversation_store.py
+#
+# Behaviour both ConversationStore implementations must share. The Redis
+# store runs against fakeredis (pip install redis fakeredis) and is skipped
+# without it.
+
+import asyncio
+
+import orjson
+import pytest
+
+from backend.conversation_store import InMemoryConversationStore, RedisConversationStore
+
+
+def _redis_store_factory(monkeypatch):
+    pytest.importorskip("fakeredis")
+    import fakeredis
+    import redis.asyncio
+
+    # fakeredis answers without ever yielding to the event loop; yield before
+    # each reply as a real socket would, so concurrent commands interleave
+    connection_class = fakeredis.FakeAsyncRedis().connection_pool.connection_class
+    read_response = connection_class.read_response
+
+    async def yielding_read_response(self, **kwargs):
+        await asyncio.sleep(0)
+        return await read_response(self, **kwargs)
+
+    monkeypatch.setattr(connection_class, "read_response", yielding_read_response)
+
+    # One server shared by every store, like several workers on one Redis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio, "from_url", lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+    )
+    return lambda **kwargs: RedisConversationStore("redis://test", **kwargs)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def make_store(request, monkeypatch):
+    if request.param == "memory":
+        return InMemoryConversationStore
+    return _redis_store_factory(monkeypatch)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_start_turn_creates_conversation_and_appends(make_store):
+    async def scenario():
+        store = make_store(history_window=2)
+        conv_id, count, _ = await store.start_turn("u1", None, "hello there", 3)
+        assert count == 1
+        assert (await store.start_turn("u1", conv_id, "second", 1))[:2] == (conv_id, 2)
+        await store.append_message("u1", conv_id, "assistant", "reply", 2)
+
+        messages = [orjson.loads(m) for m in await store.get_messages_json("u1", conv_id)]
+        assert [(m["role"], m["content"]) for m in messages] == [
+            ("user", "hello there"),
+            ("user", "second"),
+            ("assistant", "reply"),
+        ]
+        # Only the last history_window lines are kept for prompts
+        assert await store.history_lines("u1", conv_id) == [("User: second", 1), ("Assistant: reply", 2)]
+
+        [meta] = await store.list_conversations("u1")
+        assert meta["id"] == conv_id
+        assert meta["title"] == "hello there"
+        assert meta["message_count"] == 3
+
+    run(scenario())
+
+
+def test_missing_conversation(make_store):
+    async def scenario():
+        store = make_store()
+        assert await store.append_message("u1", "missing", "user", "hi", 1) is None
+        assert await store.get_messages_json("u1", "missing") is None
+        assert await store.delete_conversation("u1", "missing") is False
+        assert await store.clear_messages("u1", "missing") is False
+        # Another user's conversation is just as missing
+        conv_id, _, _ = await store.start_turn("u1", None, "hi", 1)
+        assert await store.get_messages_json("u2", conv_id) is None
+
+    run(scenario())
+
+
+def test_delete_and_clear_keep_counters(make_store):
+    async def scenario():
+        store = make_store()
+        first, _, _ = await store.start_turn("u1", None, "one", 1)
+        await store.append_message("u1", first, "assistant", "reply", 1)
+        second, _, _ = await store.start_turn("u1", None, "two", 1)
+        await store.start_turn("u2", None, "three", 1)
+        assert await store.stats() == {"total_conversations": 3, "total_messages": 4, "active_users": 2}
+
+        assert await store.clear_messages("u1", first) is True
+        assert await store.get_messages_json("u1", first) == []
+        assert await store.stats() == {"total_conversations": 3, "total_messages": 2, "active_users": 2}
+
+        assert await store.delete_conversation("u1", first) is True
+        assert await store.stats() == {"total_conversations": 2, "total_messages": 2, "active_users": 2}
+        assert await store.delete_conversation("u1", second) is True
+        assert await store.stats() == {"total_conversations": 1, "total_messages": 1, "active_users": 1}
+        assert await store.list_conversations("u1") == []
+
+    run(scenario())
+
+
+def test_undo_turn_restores_an_unchanged_turn(make_store):
+    async def scenario():
+        store = make_store()
+        older, _, _ = await store.start_turn("u1", None, "older", 1)
+        conv_id, _, _ = await store.start_turn("u1", None, "hello", 1)
+        await store.append_message("u1", conv_id, "assistant", "reply", 1)
+        before = await store.list_conversations("u1")
+        # The failed turn moves the conversation to the front, then is undone
+        await store.append_message("u1", older, "assistant", "newer reply", 1)
+        _, count, previous = await store.start_turn("u1", conv_id, "failed turn", 1)
+        assert previous is not None
+        assert [c["id"] for c in await store.list_conversations("u1")] == [conv_id, older]
+
+        assert await store.undo_turn("u1", conv_id, count, previous) is True
+        assert len(await store.get_messages_json("u1", conv_id)) == 2
+        assert await store.history_lines("u1", conv_id) == [("User: hello", 1), ("Assistant: reply", 1)]
+        after = {c["id"]: c for c in await store.list_conversations("u1")}
+        assert list(after) == [older, conv_id]
+        restored = {c["id"]: c for c in before}[conv_id]
+        assert after[conv_id] == restored
+        assert (await store.stats())["total_messages"] == 4
+
+        # Any later write means the count no longer matches
+        _, count, previous = await store.start_turn("u1", conv_id, "again", 1)
+        await store.append_message("u1", conv_id, "assistant", "reply", 1)
+        assert await store.undo_turn("u1", conv_id, count, previous) is False
+        assert await store.undo_turn("u1", "missing", 1, previous) is False
+        assert len(await store.get_messages_json("u1", conv_id)) == 4
+
+    run(scenario())
+
+
+def test_undo_of_first_turn_leaves_no_conversation(make_store):
+    async def scenario():
+        store = make_store()
+        conv_id, count, previous = await store.start_turn("u1", None, "never answered", 1)
+        assert previous is None
+
+        assert await store.undo_turn("u1", conv_id, count, previous) is True
+        assert await store.get_messages_json("u1", conv_id) is None
+        assert await store.list_conversations("u1") == []
+        assert await store.stats() == {"total_conversations": 0, "total_messages": 0, "active_users": 0}
+
+    run(scenario())
+
+
+def test_concurrent_appends_are_all_counted(make_store):
+    async def scenario():
+        store = make_store(history_window=50)
+        conv_id, _, _ = await store.start_turn("u1", None, "start", 1)
+        results = await asyncio.gather(
+            *(store.append_message("u1", conv_id, "user", f"m{i}", 1) for i in range(20))
+        )
+        assert sorted(count for _, count in results) == list(range(2, 22))
+        assert len(await store.get_messages_json("u1", conv_id)) == 21
+        assert (await store.stats())["total_messages"] == 21
+
+    run(scenario())
+
+
+def test_delete_racing_appends_keeps_counters(make_store):
+    async def scenario():
+        store = make_store()
+        conv_id, _, _ = await store.start_turn("u1", None, "start", 1)
+        # The delete reads the message count while the appends are in flight
+        await asyncio.gather(
+            *(store.append_message("u1", conv_id, "user", "late", 1) for _ in range(5)),
+            store.delete_conversation("u1", conv_id),
+        )
+        assert await store.get_messages_json("u1", conv_id) is None
+        assert await store.list_conversations("u1") == []
+        # Every message appended before the delete was subtracted with it
+        assert await store.stats() == {"total_conversations": 0, "total_messages": 0, "active_users": 0}
+
+    run(scenario())
+
+
+def test_in_memory_evicts_least_recently_used():
+    async def scenario():
+        store = InMemoryConversationStore(max_conversations=2)
+        first, _, _ = await store.start_turn("u1", None, "one", 1)
+        second, _, _ = await store.start_turn("u2", None, "two", 1)
+        # Touching the first makes the second the least recently used
+        await store.append_message("u1", first, "assistant", "reply", 1)
+        third, _, _ = await store.start_turn("u1", None, "three", 1)
+
+        assert await store.get_messages_json("u2", second) is None
+        assert await store.get_messages_json("u1", first) is not None
+        assert await store.get_messages_json("u1", third) is not None
+        assert await store.stats() == {"total_conversations": 2, "total_messages": 3, "active_users": 1}
+
+    run(scenario())
+
+
+async def _until(condition, timeout: float = 2.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_redis_l1_is_invalidated_by_other_workers(monkeypatch):
+    make_store = _redis_store_factory(monkeypatch)
+
+    async def scenario():
+        reader, writer = make_store(), make_store()
+        conv_id, _, _ = await writer.start_turn("u1", None, "start", 1)
+        key = reader._conv_key("u1", conv_id)
+
+        # The first read subscribes; reads fill L1 only once that is live
+        await reader.get_messages_json("u1", conv_id)
+        await _until(lambda: reader._l1_live)
+        assert len(await reader.get_messages_json("u1", conv_id)) == 1
+        assert (key, "msgs") in reader._l1
+
+        await writer.append_message("u1", conv_id, "assistant", "reply", 1)
+        await _until(lambda: (key, "msgs") not in reader._l1)
+        assert len(await reader.get_messages_json("u1", conv_id)) == 2
+
+        for store in (reader, writer):
+            if store._listener is not None:
+                store._listener.cancel()
+                await asyncio.gather(store._listener, return_exceptions=True)
+
+    run(scenario())
@@ -0,0 +1,58 @@
+# backend/tests/test_tokenization.py
+#
+# continuation_ids against a real SentencePiece-style tokenizer (a Llama-like
+# Metaspace BPE, trained here so no download is needed).
+
+import pytest
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+from backend.tokenization import continuation_ids
+
+FIRST_TURN = "User: hello there\nAssistant: Hi! How can I help you today?"
+NEXT_TURN = "\nUser: what is the capital of France?\nAssistant:"
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tok = Tokenizer(models.BPE(unk_token="<unk>", byte_fallback=True))
+    # Like Llama: newlines are tokens of their own, and only the start of the
+    # text gets the "▁" dummy prefix
+    tok.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split("\n", "isolated"),
+        pre_tokenizers.Metaspace(replacement="▁", prepend_scheme="first"),
+    ])
+    tok.decoder = decoders.Sequence([
+        decoders.Replace("▁", " "), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(" ", 1, 0),
+    ])
+    tok.train_from_iterator(
+        [FIRST_TURN + NEXT_TURN + " Paris is the capital."] * 50,
+        trainers.BpeTrainer(vocab_size=300, special_tokens=["<unk>", "<s>", "</s>"]),
+    )
+    tok.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 1)])
+    return PreTrainedTokenizerFast(tokenizer_object=tok, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+
+
+def test_continuation_matches_a_full_encode(tokenizer):
+    cached = tokenizer(FIRST_TURN).input_ids
+    full = tokenizer(FIRST_TURN + NEXT_TURN).input_ids
+    assert full[:len(cached)] == cached
+
+    assert cached + continuation_ids(tokenizer, cached, NEXT_TURN) == full
+    # Encoded on its own, the new turn picks up a spurious dummy prefix
+    alone = tokenizer(NEXT_TURN, add_special_tokens=False).input_ids
+    assert tokenizer.convert_ids_to_tokens(alone[0]) == "▁"
+    assert cached + alone != full
+
+
+def test_short_cache_keeps_its_special_tokens(tokenizer):
+    cached = tokenizer("User: hi").input_ids
+    assert len(cached) < 8
+    full = tokenizer("User: hi" + NEXT_TURN).input_ids
+    assert cached + continuation_ids(tokenizer, cached, NEXT_TURN) == full
+
+
+def test_join_inside_a_token_is_rejected(tokenizer):
+    # Cut mid-word: "capit" + "al." re-tokenizes into "capital."
+    cached = tokenizer("Paris is the capit").input_ids
+    assert continuation_ids(tokenizer, cached, "al.") is None
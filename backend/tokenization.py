@@ -0,0 +1,32 @@
+# backend/tokenization.py
+#
+# Token-level helpers that need only a tokenizer, not the loaded model, so
+# they can be tested on their own.
+
+from typing import Optional, Sequence
+
+# Cached tokens re-decoded to give the new text its real left context. A few
+# are enough: pre-tokenizers split on whitespace, so nothing earlier can
+# change how the new text is tokenized.
+JOIN_OVERLAP_TOKENS = 8
+
+
+def continuation_ids(
+    tokenizer, cached_ids: Sequence[int], text: str, overlap: int = JOIN_OVERLAP_TOKENS
+) -> Optional[list[int]]:
+    """Ids ``text`` gets when it follows ``cached_ids``, as in a full encode.
+
+    Encoding ``text`` on its own is not the same: SentencePiece tokenizers
+    prepend a "▁" to it, and BPE merges across the join are missed. So the
+    text is encoded after the cached tail and the tail's own ids are sliced
+    off. Returns ``None`` when appending the text re-tokenizes the tail too
+    (the join is not a token boundary); the caller must then prefill the
+    whole conversation instead.
+    """
+    tail_text = tokenizer.decode(
+        list(cached_ids[-overlap:]), clean_up_tokenization_spaces=False)
+    base = tokenizer(tail_text, add_special_tokens=False).input_ids
+    joined = tokenizer(tail_text + text, add_special_tokens=False).input_ids
+    if len(joined) <= len(base) or joined[:len(base)] != base:
+        return None
+    return joined[len(base):]
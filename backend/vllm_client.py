@@ -0,0 +1,95 @@
+# backend/vllm_client.py
+#
+# Client for a vLLM OpenAI-compatible server running as a sidecar, e.g.
+#   python -m vllm.entrypoints.openai.api_server \
+#       --model TinyLlama/TinyLlama-1.1B-Chat-v1.0 --dtype float16 \
+#       --enable-prefix-caching --port 8001
+# vLLM batches concurrent requests per decode step (continuous batching) and
+# its prefix cache reuses the shared conversation history between turns.
+
+from typing import AsyncIterator
+import os
+
+import httpx
+import orjson
+from transformers import AutoTokenizer
+
+VLLM_URL = os.getenv("VLLM_URL", "http://localhost:8001")
+VLLM_MODEL = os.getenv("VLLM_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+
+print(f"[vllm_client] Using vLLM server at {VLLM_URL} ({VLLM_MODEL})")
+
+# Only the tokenizer is loaded locally, for prompt token budgeting
+_tokenizer = AutoTokenizer.from_pretrained(VLLM_MODEL, use_fast=True)
+
+# One pooled client so requests reuse keep-alive connections to the sidecar
+_client = httpx.AsyncClient(base_url=VLLM_URL, timeout=60.0)
+
+
+def count_tokens(text: str) -> int:
+    return len(_tokenizer.encode(text, add_special_tokens=False))
+
+
+async def generate_text(
+    prompt: str,
+    max_new_tokens: int = 60,
+    temperature: float = 0.4,
+    top_p: float = 0.9,
+    do_sample: bool = True,
+    repetition_penalty: float = 1.05,
+) -> str:
+    if not prompt:
+        raise ValueError("Prompt must not be empty.")
+
+    payload = _completion_payload(
+        prompt, max_new_tokens, temperature, top_p, do_sample, repetition_penalty)
+    response = await _client.post("/v1/completions", json=payload)
+    response.raise_for_status()
+    return response.json()["choices"][0]["text"].strip()
+
+
+async def stream_text(
+    prompt: str,
+    max_new_tokens: int = 60,
+    temperature: float = 0.4,
+    top_p: float = 0.9,
+    do_sample: bool = True,
+    repetition_penalty: float = 1.05,
+) -> AsyncIterator[str]:
+    """Yield completion text chunks as vLLM streams them back."""
+    if not prompt:
+        raise ValueError("Prompt must not be empty.")
+
+    payload = _completion_payload(
+        prompt, max_new_tokens, temperature, top_p, do_sample, repetition_penalty)
+    payload["stream"] = True
+    async with _client.stream("POST", "/v1/completions", json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            chunk = orjson.loads(data)["choices"][0]["text"]
+            if chunk:
+                yield chunk
+
+
+def _completion_payload(
+    prompt: str,
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    do_sample: bool,
+    repetition_penalty: float,
+) -> dict:
+    return {
+        "model": VLLM_MODEL,
+        "prompt": prompt,
+        "max_tokens": max_new_tokens,
+        # vLLM has no do_sample flag; temperature 0 selects greedy decoding
+        "temperature": temperature if do_sample else 0.0,
+        "top_p": top_p if do_sample else 1.0,
+        "repetition_penalty": repetition_penalty,
+    }
@@ -2,83 +2,421 @@
 Start both the FastAPI backend and Next.js frontend for local development.
 
 Usage:
-    python start_services.py
+    python start_services.py [--only backend|frontend|both] [--prod [--workers N]]
+                             [--force-backend] [--nice]
 
 Requirements:
 - Backend Python deps installed (`pip install -r backend/requirements.txt`)
 - Frontend deps installed (`npm install`)
 """
 
+import argparse
 import os
+import selectors
+import shutil
 import signal
+import socket
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Collection, Optional
 
 ROOT = Path(__file__).resolve().parent
 
-# Use npm.cmd on Windows so the frontend script launches correctly.
-if os.name == "nt":
-    FRONTEND_CMD = ["npm.cmd", "run", "dev", "--", "--port", "3000"]
-else:
-    FRONTEND_CMD = ["npm", "run", "dev", "--", "--port", "3000"]
+BACKEND_PORT = 8000
 
+# How far --nice lowers the frontend's CPU priority on POSIX
+NICE_INCREMENT = 5
 
-def start_process(cmd: list[str], cwd: Path, name: str) -> subprocess.Popen:
-    env = os.environ.copy()
-    if name == "frontend" and "NEXT_PUBLIC_API_URL" not in env:
-        env["NEXT_PUBLIC_API_URL"] = "http://localhost:8000/api"
+# How long children get to exit after SIGTERM before they are killed
+GRACE_SECONDS = float(os.environ.get("RUNNER_GRACE_SECONDS", "5"))
+
+# Copied once; the children never mutate the env they are given
+_BASE_ENV = os.environ.copy()
+
+_ENV_DEFAULTS = {
+    "backend": {
+        # Logs stay line-by-line when piped (tee, Docker) instead of 4 KB blocks
+        "PYTHONUNBUFFERED": "1",
+        # No __pycache__ churn on every --reload
+        "PYTHONDONTWRITEBYTECODE": "1",
+    },
+    "frontend": {
+        "NEXT_PUBLIC_API_URL": f"http://localhost:{BACKEND_PORT}/api",
+        "NODE_ENV": "development",
+        # next dev otherwise phones home on every start
+        "NEXT_TELEMETRY_DISABLED": "1",
+    },
+}
+
+# Use npm.cmd on Windows so the frontend script launches correctly. Resolved
+# once here so the children exec an absolute path; if npm is not on PATH the
+# bare name is kept and the spawn reports it missing.
+_NPM_NAME = "npm.cmd" if os.name == "nt" else "npm"
+NPM = shutil.which(_NPM_NAME) or _NPM_NAME
+FRONTEND_CMD = [NPM, "run", "dev", "--", "--port", "3000"]
+
+
+def backend_command(prod: bool = False, workers: int = 1) -> list[str]:
+    cmd = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "backend.main:app",
+        "--host",
+        "0.0.0.0",
+        "--port",
+        str(BACKEND_PORT),
+        # uvicorn[standard] ships both; uvloop has no Windows build
+        "--loop",
+        "asyncio" if os.name == "nt" else "uvloop",
+        "--http",
+        "httptools",
+    ]
+    if prod:
+        # uvicorn ignores --workers under --reload, so the two are exclusive
+        cmd += ["--workers", str(workers), "--no-access-log"]
+    else:
+        cmd.append("--reload")
+    return cmd
+
+
+def service_env(name: str) -> dict[str, str]:
+    """The child's environment; shared and unchanged unless it needs additions."""
+    defaults = _ENV_DEFAULTS.get(name, {})
+    if all(key in _BASE_ENV for key in defaults):
+        return _BASE_ENV
+    # Anything already set in the runner's environment wins
+    return {**defaults, **_BASE_ENV}
+
+
+def backend_running() -> bool:
+    """Whether something already accepts connections on the backend port."""
+    with socket.socket() as sock:
+        sock.settimeout(0.5)
+        return sock.connect_ex(("127.0.0.1", BACKEND_PORT)) == 0
+
+
+def low_priority_command(cmd: list[str]) -> list[str]:
+    """Wrap cmd to run at lower CPU and I/O priority (POSIX).
+
+    Wrapping rather than a preexec_fn keeps Popen on its vfork fast path.
+    """
+    # Best-effort class at its lowest level rather than the idle class, which
+    # could stall next dev entirely while the IDE is indexing
+    prefix = ["nice", "-n", str(NICE_INCREMENT)]
+    if shutil.which("ionice"):
+        prefix = ["ionice", "-c", "2", "-n", "7", *prefix]
+    return [*prefix, *cmd]
+
+
+def exec_service(cmd: list[str], cwd: Path, name: str, low_priority: bool = False) -> None:
+    """Replace the runner with a single service; does not return.
+
+    With nothing to supervise, the service takes over the runner's pid, so
+    signals from the terminal or a container runtime reach it directly.
+    """
+    if low_priority:
+        cmd = low_priority_command(cmd)
+    print(f"[runner] exec {name}: {' '.join(cmd)} (cwd={cwd})", flush=True)
+    os.chdir(cwd)
+    os.execvpe(cmd[0], cmd, service_env(name))
+
+
+def start_process(
+    cmd: list[str], cwd: Path, name: str, low_priority: bool = False
+) -> subprocess.Popen:
+    env = service_env(name)
+    if low_priority and os.name != "nt":
+        cmd = low_priority_command(cmd)
     print(f"[runner] starting {name}: {' '.join(cmd)} (cwd={cwd})", flush=True)
+    # Each child leads its own process group, so shutdown can signal its
+    # whole tree (uvicorn's reloader worker, Next.js's build workers) rather
+    # than leaving those behind holding ports 8000/3000
+    if os.name == "nt":
+        flags = subprocess.CREATE_NEW_PROCESS_GROUP
+        if low_priority:
+            flags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        group_kwargs = {"creationflags": flags}
+    else:
+        group_kwargs = {"start_new_session": True}
     return subprocess.Popen(
         cmd,
         cwd=str(cwd),
         env=env,
-        stdout=sys.stdout,
-        stderr=sys.stderr,
+        **group_kwargs,
     )
 
 
-def main() -> int:
-    processes: list[tuple[str, subprocess.Popen]] = []
-    try:
-        backend_cmd = [
-            sys.executable,
-            "-m",
-            "uvicorn",
-            "backend.main:app",
-            "--reload",
-            "--host",
-            "0.0.0.0",
-            "--port",
-            "8000",
+def start_all(
+    services: list[tuple[str, list[str]]],
+    processes: list[tuple[str, subprocess.Popen]],
+    low_priority: Collection[str] = (),
+) -> None:
+    """Spawn every service at once, appending each started child to processes.
+
+    Popen blocks until the child has exec'd, so overlapping the spawns saves
+    the slower one's startup. A child that did start is still recorded when
+    another fails, so the caller can stop it. Services named in low_priority
+    run niced.
+    """
+    with ThreadPoolExecutor(max_workers=len(services)) as pool:
+        futures = [
+            (name, pool.submit(start_process, cmd, ROOT, name, name in low_priority))
+            for name, cmd in services
         ]
-        frontend_cmd = FRONTEND_CMD
+    error: Optional[Exception] = None
+    for name, future in futures:
+        try:
+            processes.append((name, future.result()))
+        except Exception as exc:
+            error = error or exc
+    if error is not None:
+        raise error
+
+
+def terminate_group(proc: subprocess.Popen) -> None:
+    try:
+        if os.name == "nt":
+            # Delivered to every process in the child's console group
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            # The group id is the leader's pid, valid even after it exited
+            os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def group_alive(proc: subprocess.Popen) -> bool:
+    """Whether the child, or anything left in its process group, still runs."""
+    if proc.poll() is None:
+        return True
+    if os.name == "nt":
+        # No group to probe; CTRL_BREAK_EVENT was the best we could do
+        return False
+    try:
+        os.killpg(proc.pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def kill_group(proc: subprocess.Popen) -> None:
+    try:
+        if os.name == "nt":
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def open_exit_selector(
+    processes: list[tuple[str, subprocess.Popen]],
+) -> Optional[selectors.BaseSelector]:
+    """Selector with one pidfd per child, readable once that child exits.
+
+    An interactive stdin is registered too (with no process), so typing
+    q<Enter> can stop the runner where Ctrl+C is intercepted, e.g. in IDE
+    terminals. Returns None where pidfds are unavailable (non-Linux, or
+    kernels before 5.3); callers then fall back to waitpid, or polling on
+    Windows.
+    """
+    if not hasattr(os, "pidfd_open"):
+        return None
+    sel = selectors.DefaultSelector()
+    try:
+        for name, proc in processes:
+            sel.register(os.pidfd_open(proc.pid), selectors.EVENT_READ, (name, proc))
+    except OSError:
+        close_exit_selector(sel)
+        return None
+    if sys.stdin is not None and sys.stdin.isatty():
+        sel.register(sys.stdin, selectors.EVENT_READ, ("stdin", None))
+    return sel
+
+
+def close_exit_selector(sel: selectors.BaseSelector) -> None:
+    for key in list(sel.get_map().values()):
+        sel.unregister(key.fd)
+        # stdin is only watched, not owned
+        if key.data[1] is not None:
+            os.close(key.fd)
+    sel.close()
 
-        processes.append(("backend", start_process(backend_cmd, ROOT, "backend")))
-        processes.append(("frontend", start_process(frontend_cmd, ROOT, "frontend")))
 
-        print("\n[runner] services running. Press Ctrl+C to stop.")
+def wait_for_exit(
+    processes: list[tuple[str, subprocess.Popen]], sel: Optional[selectors.BaseSelector]
+) -> Optional[tuple[str, int]]:
+    """Block until any child exits; returns its name and exit code.
 
+    Returns None instead if the user typed q on stdin.
+    """
+    if sel is not None:
+        # No wakeups until a child exits or a line is typed
         while True:
-            time.sleep(1)
-            for name, proc in processes:
-                ret = proc.poll()
-                if ret is not None:
-                    print(f"[runner] {name} exited with code {ret}", flush=True)
-                    return ret or 0
+            for key, _ in sel.select():
+                name, proc = key.data
+                if proc is not None:
+                    return name, proc.wait()
+                # The tty is in canonical mode, so this is one whole line
+                line = os.read(key.fd, 1024)
+                if not line:
+                    sel.unregister(key.fd)
+                elif line.strip() == b"q":
+                    return None
+
+    if os.name != "nt":
+        # Without pidfds, block in waitpid instead; the runner has no
+        # children other than these
+        by_pid = {proc.pid: (name, proc) for name, proc in processes}
+        while True:
+            pid, status = os.waitpid(-1, 0)
+            if pid in by_pid:
+                name, proc = by_pid[pid]
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                return name, proc.returncode
+
+    while True:
+        time.sleep(1)
+        for name, proc in processes:
+            ret = proc.poll()
+            if ret is not None:
+                return name, ret
+
+
+def stop_processes(processes: list[tuple[str, subprocess.Popen]]) -> None:
+    """Terminate every child's group, then kill whichever outlives the grace period."""
+    for name, proc in processes:
+        if proc.poll() is None:
+            print(f"[runner] terminating {name}...", flush=True)
+        # Even if the leader is gone, its children may not be
+        terminate_group(proc)
+    # One deadline for all, so shutdown takes as long as the slowest child,
+    # never more than GRACE_SECONDS
+    deadline = time.monotonic() + GRACE_SECONDS
+    for name, proc in processes:
+        try:
+            proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            pass
+    # A leader can exit before the rest of its group (npm before its node
+    # child), so members get the remaining grace period too
+    alive = [(name, proc) for name, proc in processes if group_alive(proc)]
+    while alive and time.monotonic() < deadline:
+        time.sleep(0.05)
+        alive = [(name, proc) for name, proc in alive if group_alive(proc)]
+    for name, proc in alive:
+        print(f"[runner] killing {name}...", flush=True)
+        kill_group(proc)
+        proc.wait()
+
+
+def _raise_interrupt(signum, frame) -> None:
+    raise KeyboardInterrupt
+
+
+def install_stop_handlers() -> None:
+    """Route SIGTERM/SIGHUP through the Ctrl+C shutdown path.
+
+    Docker and systemd stop the runner with SIGTERM, and closing its terminal
+    sends SIGHUP; by default either would kill it without stopping the
+    children. Handlers are reset across exec, so the children keep default
+    dispositions.
+    """
+    for sig_name in ("SIGTERM", "SIGHUP"):
+        sig = getattr(signal, sig_name, None)
+        if sig is not None:
+            signal.signal(sig, _raise_interrupt)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the backend and frontend dev servers.")
+    parser.add_argument(
+        "--only",
+        choices=("backend", "frontend", "both"),
+        default="both",
+        help="start a single service instead of both (default: both)",
+    )
+    parser.add_argument(
+        "--prod",
+        action="store_true",
+        help="run the backend without --reload, e.g. for benchmarking",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="backend worker processes with --prod (default: $WORKERS or 1)",
+    )
+    parser.add_argument(
+        "--force-backend",
+        action="store_true",
+        help="start the backend even if one is already listening on its port",
+    )
+    parser.add_argument(
+        "--nice",
+        action="store_true",
+        help="run the frontend at lower CPU/IO priority so rebuilds don't starve the editor",
+    )
+    args = parser.parse_args(argv)
+    if args.workers is not None and not args.prod:
+        parser.error("--workers requires --prod; uvicorn cannot reload multiple workers")
+    if args.workers is None:
+        args.workers = int(os.environ.get("WORKERS", "1"))
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = parse_args(argv)
+    services = [
+        ("backend", backend_command(args.prod, args.workers)),
+        ("frontend", FRONTEND_CMD),
+    ]
+    if args.only == "both" and not args.force_backend and backend_running():
+        # Spare the uvicorn cold start when only the frontend is being restarted
+        print(f"[runner] reusing existing backend on :{BACKEND_PORT}", flush=True)
+        services = [service for service in services if service[0] != "backend"]
+    elif args.only != "both":
+        services = [service for service in services if service[0] == args.only]
+        # Windows has no real exec (the "replacement" gets a new pid and the
+        # console returns early), so a lone service is supervised there
+        if os.name != "nt":
+            name, cmd = services[0]
+            exec_service(cmd, ROOT, name, low_priority=args.nice and name == "frontend")
+
+    install_stop_handlers()
+    processes: list[tuple[str, subprocess.Popen]] = []
+    sel: Optional[selectors.BaseSelector] = None
+    try:
+        start_all(services, processes, {"frontend"} if args.nice else ())
+
+        sel = open_exit_selector(processes)
+
+        watching_stdin = sel is not None and any(
+            key.data[1] is None for key in sel.get_map().values()
+        )
+        if watching_stdin:
+            print("\n[runner] services running. Press Ctrl+C or type q<Enter> to stop.")
+        else:
+            print("\n[runner] services running. Press Ctrl+C to stop.")
+
+        exited = wait_for_exit(processes, sel)
+        if exited is None:
+            print("[runner] quit requested, stopping...", flush=True)
+            return 0
+        name, ret = exited
+        print(f"[runner] {name} exited with code {ret}", flush=True)
+        return ret or 0
     except KeyboardInterrupt:
         print("\n[runner] received interrupt, stopping...", flush=True)
     finally:
-        for name, proc in processes:
-            if proc.poll() is None:
-                print(f"[runner] terminating {name}...", flush=True)
-                proc.terminate()
-        time.sleep(2)
-        for name, proc in processes:
-            if proc.poll() is None:
-                print(f"[runner] killing {name}...", flush=True)
-                proc.kill()
+        if sel is not None:
+            close_exit_selector(sel)
+        stop_processes(processes)
     return 0
 
 